@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+import ssl
+import sys
+import threading
+import traceback
+from http import HTTPStatus
+from server import makeSSLContext, handleRequest
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class badRequest(Exception):
+
+  def __init__(self, status):
+    super(badRequest, self).__init__(status)
+    self.status = status
+
+
+class asyncWebHook(threading.Thread):
+  """Webhook server running on an asyncio event loop in a single thread.
+
+  Serves the same endpoints as server.webHook with a preloaded SSLContext,
+  keep-alive connections, a bounded number of concurrent connections and a
+  limit on request bodies.
+  """
+  MAX_HEADERS = 64
+  MAX_LINE = 8192
+
+  def __init__(self, conf, q):
+    threading.Thread.__init__(self, daemon=True)
+    web = conf['web']
+    self.token = conf['bot']['token']
+    self.q = q
+    self.port = web.get('port', 8443)
+    self.max_connections = web.get('max_connections', 64)
+    self.max_body = web.get('max_body', 1 << 20)
+    self.keepalive = web.get('keepalive_timeout', 30)
+    self.context = makeSSLContext(web['cert'])
+
+  def run(self):
+    # asyncio.run and Server.serve_forever need python 3.7.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    self.connections = 0
+    kwargs = {}
+    if sys.version_info >= (3, 7):
+      kwargs['ssl_handshake_timeout'] = 2.
+    server = loop.run_until_complete(
+        asyncio.start_server(
+            self.handle,
+            '0.0.0.0',
+            self.port,
+            ssl=self.context,
+            limit=self.MAX_LINE,
+            **kwargs))
+    try:
+      loop.run_forever()
+    finally:
+      server.close()
+      loop.run_until_complete(server.wait_closed())
+      loop.close()
+
+  async def readRequest(self, reader):
+    """Returns (path, headers, body) or None if the peer closed connection."""
+    line = await reader.readline()
+    if not line:
+      return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+      raise badRequest(HTTPStatus.BAD_REQUEST)
+    headers = {}
+    while True:
+      line = await reader.readline()
+      if line in (b'\r\n', b'\n'):
+        break
+      if not line or len(headers) >= self.MAX_HEADERS:
+        raise badRequest(HTTPStatus.BAD_REQUEST)
+      name, _, value = line.decode('latin-1').partition(':')
+      headers[name.strip().lower()] = value.strip()
+    try:
+      length = int(headers.get('content-length', 0))
+    except ValueError:
+      raise badRequest(HTTPStatus.BAD_REQUEST)
+    if length > self.max_body:
+      raise badRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length)
+    return parts[1], headers, body
+
+  async def respond(self,
+                    writer,
+                    status,
+                    content_type=None,
+                    payload=b'',
+                    close=False):
+    status = HTTPStatus(status)
+    lines = [f'HTTP/1.1 {status.value} {status.phrase}']
+    if content_type is not None:
+      lines.append(f'Content-Type: {content_type}')
+    lines.append(f'Content-Length: {len(payload)}')
+    if close:
+      lines.append('Connection: close')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+    await writer.drain()
+
+  async def handle(self, reader, writer):
+    if self.connections >= self.max_connections:
+      try:
+        await self.respond(writer, HTTPStatus.SERVICE_UNAVAILABLE, close=True)
+      except Exception:
+        pass
+      writer.close()
+      return
+    self.connections += 1
+    try:
+      while True:
+        try:
+          request = await asyncio.wait_for(
+              self.readRequest(reader), self.keepalive)
+        except badRequest as e:
+          await self.respond(writer, e.status, close=True)
+          break
+        if request is None:
+          break
+        path, headers, body = request
+        # Queueing is cheap enough to run on the loop.
+        status, content_type, payload = handleRequest(path, body, self.token,
+                                                      self.q)
+        close = headers.get('connection', '').lower() == 'close'
+        await self.respond(writer, status, content_type, payload, close)
+        if close:
+          break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+            ssl.SSLError, ValueError):
+      # ValueError is raised for lines longer than MAX_LINE.
+      pass
+    except Exception as e:
+      logger.error('{} {}', e, datetime.datetime.now())
+      traceback.print_exc()
+    finally:
+      self.connections -= 1
+      writer.close()
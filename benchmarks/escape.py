@@ -0,0 +1,137 @@
+"""Checks escape/unescape against their original implementations and times them.
+
+Usage: python benchmarks/escape.py [ITERATIONS]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from markdownrenderer import convertDiscourseToTelegram, escape, unescape
+
+
+def legacyUnescape(text):
+  toEscape = {
+      False: [
+          '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|',
+          '{', '}', '.', '!'
+      ],
+      True: ['`', '\\']
+  }
+
+  res = ''
+  i = 0
+  insideCodeBlock = False
+  while i < len(text):
+    if text[i] in toEscape[insideCodeBlock]:
+      if text[i] == '`':
+        insideCodeBlock = not insideCodeBlock
+      i += 1
+      continue
+    if text[i] == '\\':
+      if i + 1 < len(text) and text[i + 1] in toEscape[insideCodeBlock]:
+        i += 1
+    res += text[i]
+    i += 1
+  return res
+
+
+def legacyEscape(text, inCodeBlock=False):
+  if not inCodeBlock:
+    toEscape = [
+        '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|',
+        '{', '}', '.', '!'
+    ]
+  else:
+    toEscape = ['`', '\\']
+
+  res = ''
+  for t in text:
+    if t in toEscape:
+      res += '\\'
+    res += t
+  return res
+
+
+CORPUS = [
+    '',
+    'plain text without anything special',
+    'Hello, world!',
+    '\\',
+    '\\\\',
+    '\\_',
+    '\\\\_',
+    'trailing backslash \\',
+    '`',
+    '``',
+    '`code` outside',
+    '```\ncode \\` block\n```',
+    '```py\nprint("a\\\\b")\n```\nafter *bold* _it_',
+    '[link](https://example.com/a_b?c=d#e)',
+    '\\> quoted _text_ with \\[brackets\\]',
+    'unclosed `code \\ with \\` escapes',
+    'emoji 👍 and türkçe karakterler ığüşöç',
+    '1\\. item\n2\\. item\n\\- bullet',
+    '~strike~ ||spoiler|| {braces} +-=|!.',
+]
+
+# Posts and their rendering, covering link text with nested inline markup.
+RENDER_CORPUS = [
+    ('[plain](https://example.com)', '[plain](https://example.com)'),
+    ('[a_b](https://example.com)', '[a\\_b](https://example.com)'),
+    ('[**bold** _it_ `code` a.b](https://example.com)',
+     '[*bold* _it_ `code` a\\.b](https://example.com)'),
+    ('<https://example.com/a_b>',
+     '[https://example\\.com/a\\_b](https://example.com/a_b)'),
+]
+
+ALPHABET = 'ab \n_*[]()~`>#+-=|{}.!\\ç👍'
+
+
+def fuzzCorpus(count=2000, seed=0):
+  rnd = random.Random(seed)
+  return [
+      ''.join(rnd.choice(ALPHABET)
+              for _ in range(rnd.randint(0, 64)))
+      for _ in range(count)
+  ]
+
+
+def checkEquivalence():
+  for text in CORPUS + fuzzCorpus():
+    for inCodeBlock in (False, True):
+      assert escape(text, inCodeBlock) == legacyEscape(text, inCodeBlock), text
+    assert unescape(text) == legacyUnescape(text), text
+    escaped = legacyEscape(text)
+    assert unescape(escaped) == legacyUnescape(escaped), escaped
+  for content, rendered in RENDER_CORPUS:
+    paragraphs, _ = convertDiscourseToTelegram(content)
+    assert '\n\n'.join(paragraphs) == rendered, content
+
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  checkEquivalence()
+  print('escape/unescape match the original implementations')
+
+  # A long post with prose and code, roughly what a render produces.
+  text = ('Some prose, with punctuation (and links) [x](y). ' * 40 +
+          '```\nint main() { return a[i] * b_c - 1; }\n```\n') * 10
+  escaped = escape(text)
+  cases = [
+      ('escape', lambda: escape(text), lambda: legacyEscape(text)),
+      ('escape(code)', lambda: escape(text, True),
+       lambda: legacyEscape(text, True)),
+      ('unescape', lambda: unescape(escaped), lambda: legacyUnescape(escaped)),
+  ]
+  print(f'{len(text)} chars, {iterations} iterations')
+  for name, new, old in cases:
+    new_time = timeit.timeit(new, number=iterations) / iterations
+    old_time = timeit.timeit(old, number=iterations) / iterations
+    print(f'{name:14} {new_time * 1e6:10.1f}us {old_time * 1e6:10.1f}us '
+          f'(legacy) x{old_time / new_time:.1f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,239 @@
+"""Local stand-ins for the Discourse and Telegram Bot APIs used by the bot.
+
+Both servers run on a background thread and only implement what newsReader
+and cowBot use. They are meant for load tests, see benchmarks/load.py.
+"""
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+POST_URL_REGEX = re.compile(r'/p/(\d+)\)')
+
+
+class threadedServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  # The default backlog of 5 resets connections when every worker connects.
+  request_queue_size = 128
+
+
+class jsonHandler(BaseHTTPRequestHandler):
+  """Passes requests to server.app.handle(method, path, query, body, headers).
+
+  handle returns (status, payload, headers), payload is sent as json unless
+  it is None.
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def respond(self, method):
+    url = urlparse(self.path)
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    status, payload, headers = self.server.app.handle(method,
+                                                      url.path.rstrip('/'),
+                                                      parse_qs(url.query), body,
+                                                      self.headers)
+    data = b'' if payload is None else json.dumps(payload).encode('utf-8')
+    self.send_response(status)
+    for name, value in headers.items():
+      self.send_header(name, value)
+    if payload is not None:
+      self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    self.respond('GET')
+
+  def do_POST(self):
+    self.respond('POST')
+
+  def log_message(self, *args):
+    pass
+
+
+class fakeServer:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.httpd = threadedServer(('127.0.0.1', 0), jsonHandler)
+    self.httpd.app = self
+    self.port = self.httpd.server_address[1]
+    threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+  def url(self):
+    return f'http://127.0.0.1:{self.port}'
+
+  def close(self):
+    self.httpd.shutdown()
+
+
+class fakeDiscourse(fakeServer):
+  """Serves categories, a latest posts listing, posts and topics.
+
+  Posts are added with addPosts, their creation times are kept to measure
+  delivery latency.
+  """
+  PAGE_SIZE = 50
+
+  def __init__(self, categories, contents, seed=0):
+    self.random = random.Random(seed)
+    # [{'id', 'name', 'parent_category_id'}]
+    self.categories = categories
+    self.contents = contents
+    self.posts = {}
+    self.topics = {}
+    self.created = {}
+    self.requests = {}
+    super(fakeDiscourse, self).__init__()
+
+  def addPosts(self, count):
+    """Creates count posts in random categories, returns their ids."""
+    parents = {c.get('parent_category_id') for c in self.categories}
+    leaves = [c['id'] for c in self.categories if c['id'] not in parents]
+    ids = []
+    with self.lock:
+      for _ in range(count):
+        post_id = len(self.posts) + 1
+        topic_id = post_id
+        category_id = self.random.choice(leaves)
+        title = f'Topic {topic_id}'
+        self.topics[topic_id] = {'category_id': category_id, 'title': title}
+        self.posts[post_id] = dict(
+            id=post_id,
+            topic_id=topic_id,
+            category_id=category_id,
+            topic_title=title,
+            username=f'user{post_id % 97}',
+            name=f'User {post_id % 97}',
+            created_at=datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z'),
+            raw=self.random.choice(self.contents))
+        self.created[post_id] = time.monotonic()
+        ids.append(post_id)
+    return ids
+
+  def listing(self, before):
+    ids = sorted((i for i in self.posts if not before or i < before),
+                 reverse=True)
+    return [self.posts[i] for i in ids[:self.PAGE_SIZE]]
+
+  def handle(self, method, path, query, body, headers):
+    with self.lock:
+      name = re.sub(r'\d+', '{id}', path)
+      self.requests[name] = self.requests.get(name, 0) + 1
+      if method == 'POST':
+        # Session login, the auth token comes in a cookie.
+        return 200, {}, {'Set-Cookie': '_t=loadtest; path=/; HttpOnly'}
+      if path == '/site.json':
+        etag = f'"categories-{len(self.categories)}"'
+        if headers.get('If-None-Match') == etag:
+          return 304, None, {}
+        return 200, {'categories': self.categories}, {'ETag': etag}
+      if path == '/posts.json':
+        before = int(query.get('before', ['0'])[0])
+        etag = f'"posts-{max(self.posts, default=0)}"'
+        if not before and headers.get('If-None-Match') == etag:
+          return 304, None, {}
+        return 200, {'latest_posts': self.listing(before)}, {'ETag': etag}
+      m = re.fullmatch(r'/posts/(\d+)\.json', path)
+      if m and int(m.group(1)) in self.posts:
+        return 200, self.posts[int(m.group(1))], {}
+      m = re.fullmatch(r'/t/(\d+)\.json', path)
+      if m and int(m.group(1)) in self.topics:
+        return 200, self.topics[int(m.group(1))], {}
+      return 404, {'errors': ['not found']}, {}
+
+
+class fakeTelegram(fakeServer):
+  """Accepts Bot API calls in json bodies like api.telegram.org does.
+
+  Enforces a global and a per chat rate with 429 retry_after responses,
+  answers 403 for chats in blocked and can reject a share of the requests
+  with 429 at random. Deliveries of articles are recorded with the time the
+  first chunk arrived.
+  """
+
+  def __init__(self,
+               global_rate=30,
+               chat_rate=1,
+               group_rate=20 / 60.,
+               blocked=(),
+               flood_ratio=0.,
+               retry_after=1,
+               seed=0):
+    self.random = random.Random(seed)
+    self.global_rate = global_rate
+    self.chat_rate = chat_rate
+    self.group_rate = group_rate
+    self.blocked = set(blocked)
+    self.flood_ratio = flood_ratio
+    self.retry_after = retry_after
+    self.buckets = {}
+    self.requests = {}
+    self.errors = {}
+    # (post id, chat id) -> time the article arrived
+    self.deliveries = {}
+    self.file_ids = 0
+    super(fakeTelegram, self).__init__()
+
+  def take(self, key, rate, now):
+    """Takes a token from a bucket holding a second worth of tokens."""
+    tokens, stamp = self.buckets.get(key, (max(1., rate), now))
+    tokens = min(max(1., rate), tokens + (now - stamp) * rate)
+    if tokens < 1:
+      self.buckets[key] = (tokens, now)
+      return False
+    self.buckets[key] = (tokens - 1, now)
+    return True
+
+  def error(self, code, description, parameters=None):
+    self.errors[code] = self.errors.get(code, 0) + 1
+    res = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+      res['parameters'] = parameters
+    return code, res, {}
+
+  def document(self):
+    self.file_ids += 1
+    return {'document': {'file_id': f'file{self.file_ids}'}}
+
+  def handle(self, method, path, query, body, headers):
+    try:
+      data = json.loads(body or b'{}')
+    except ValueError:
+      # setWebhook uploads a certificate as multipart form data.
+      data = {'method': 'setWebhook'}
+    api_method = data.get('method', path.rsplit('/', 1)[-1])
+    now = time.monotonic()
+    with self.lock:
+      self.requests[api_method] = self.requests.get(api_method, 0) + 1
+      cid = data.get('chat_id')
+      if cid is None:
+        return 200, {'ok': True, 'result': True}, {}
+      if cid in self.blocked:
+        return self.error(403, 'Forbidden: bot was blocked by the user')
+      rate = self.chat_rate if cid > 0 else self.group_rate
+      if (self.random.random() < self.flood_ratio or
+          not self.take(None, self.global_rate, now) or
+          not self.take(cid, rate, now)):
+        return self.error(429,
+                          f'Too Many Requests: retry after {self.retry_after}',
+                          {'retry_after': self.retry_after})
+      if api_method == 'sendMessage':
+        m = POST_URL_REGEX.search(data.get('text', ''))
+        if m:
+          self.deliveries.setdefault((int(m.group(1)), cid), now)
+        result = {'message_id': 1, 'chat': {'id': cid}}
+      elif api_method == 'sendDocument':
+        result = self.document()
+      elif api_method == 'sendMediaGroup':
+        result = [self.document() for _ in data.get('media', [])]
+      else:
+        result = True
+      return 200, {'ok': True, 'result': result}, {}
@@ -0,0 +1,285 @@
+"""Measures forum poll to delivery latency of the bot against fake servers.
+
+The real cowBot polls a fake Discourse and sends to a fake Telegram, see
+benchmarks/fakes.py, while users and subscriptions are seeded into a scratch
+MySQL database given by a JSON file such as conf.ini:
+
+  python benchmarks/load.py --db conf.ini --users 1000 --subscriptions 5000 \\
+      --posts 100
+
+The tables are created from db.sql. A database that already has rows in them
+is only used with --reset, which deletes every row the bot stores, so never
+point this at a production database. Once the burst of posts is delivered, or --timeout
+passes, latency percentiles and sends per second are printed.
+
+Only the path of new posts is measured: forum polling, rendering, the outbox
+and the dispatcher. The bot runs in polling mode just to skip setWebhook, no
+updatePoller or webhook server is started, so receiving commands isn't part of
+the measurement. See the README for the other limits.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+
+import MySQLdb
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+from bot import cowBot
+from fakes import fakeDiscourse, fakeTelegram
+from render import loadCorpus
+
+# Chat ids of the synthetic users, far from real ones.
+FIRST_CID = 1000000
+# Posts already on the forum when the bot starts.
+EXISTING_POSTS = 10
+# Tables cleared by --reset, children first.
+TABLES = ('outbox', 'articles', 'broadcasts', 'aliases', 'topics', 'users')
+
+
+def makeCategories(count):
+  """Returns count courses under a department, in site.json form."""
+  categories = [{'id': 1, 'name': 'ceng'}]
+  for i in range(count):
+    categories.append({
+        'id': i + 2,
+        'name': f'course{100 + i}',
+        'parent_category_id': 1
+    })
+  return categories
+
+
+def readDb(path):
+  """Reads host, user, pass and name from a json file or conf.ini's db."""
+  with open(path) as f:
+    db = json.load(f)
+  db = db.get('db', db)
+  return {key: db[key] for key in ('host', 'user', 'pass', 'name')}
+
+
+def createTables(db, reset):
+  """Creates the tables from db.sql, returns an open connection.
+
+  Exits unless the tables are empty or reset is given, which empties them.
+  """
+  conn = MySQLdb.connect(
+      db['host'], db['user'], db['pass'], db['name'], charset='utf8mb4')
+  cur = conn.cursor()
+  with open(os.path.join(ROOT, 'db.sql')) as f:
+    for statement in f.read().split(';'):
+      if statement.strip():
+        cur.execute(statement)
+  for table in TABLES:
+    cur.execute(f'SELECT COUNT(*) FROM `{table}`')
+    if cur.fetchone()[0] and not reset:
+      raise SystemExit(f'Database has {table}, pass --reset to delete them.')
+  if reset:
+    for table in TABLES:
+      cur.execute(f'DELETE FROM `{table}`')
+  conn.commit()
+  cur.close()
+  return conn
+
+
+def seed(db, users, subscriptions, category_ids, reset, rnd):
+  """Creates the tables, users and subscriptions.
+
+  Returns {category id: set of subscribed cids}.
+  """
+  conn = createTables(db, reset)
+  cur = conn.cursor()
+  cids = [FIRST_CID + i for i in range(users)]
+  cur.executemany(
+      'INSERT INTO `users` (`uid`, `cid`, `uname`) VALUES (%s, %s, %s)',
+      [(cid, cid, f'user{cid}') for cid in cids])
+  pairs = set()
+  while len(pairs) < min(subscriptions, users * len(category_ids)):
+    pairs.add((rnd.choice(cids), rnd.choice(category_ids)))
+  cur.executemany('INSERT INTO `topics` (`cid`, `topic`) VALUES (%s, %s)',
+                  sorted(pairs))
+  conn.commit()
+  cur.close()
+  conn.close()
+
+  subscribers = {}
+  for cid, cat_id in pairs:
+    subscribers.setdefault(cat_id, set()).add(cid)
+  return subscribers
+
+
+def makeConf(args, db, discourse, telegram, tmp):
+  return {
+      'bot': {
+          'token': 'loadtest',
+          'url': '',
+          'api': telegram.url(),
+          'mode': 'polling',
+          'offset_file': os.path.join(tmp, 'update_offset'),
+          'command_workers': 2
+      },
+      'web': {},
+      'news': {
+          'host': discourse.url() + '/',
+          'auth': 'session',
+          'port': 0,
+          'user': 'loadtest',
+          'pass': 'loadtest',
+          'last': os.path.join(tmp, 'lpost_file'),
+          'timezone': 3,
+          'topic_cache': os.path.join(tmp, 'topic_cache.json'),
+          'poll_min_interval': args.poll_interval,
+          'poll_max_interval': args.poll_interval
+      },
+      'dispatch': {
+          'workers': args.workers,
+          'global_rate': args.global_rate,
+          'chat_rate': args.chat_rate
+      },
+      'db': dict(db, pool_size=args.pool_size)
+  }
+
+
+def percentile(values, q):
+  """values must be sorted."""
+  return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def delivered(telegram, post_ids):
+  """Returns {(post id, cid): arrival time} for the posts in post_ids."""
+  with telegram.lock:
+    return {
+        key: stamp
+        for key, stamp in telegram.deliveries.items()
+        if key[0] in post_ids
+    }
+
+
+def report(args, expected, deliveries, discourse, telegram, burst_start):
+  latencies = sorted(
+      stamp - discourse.created[pid] for (pid, _), stamp in deliveries.items())
+  duration = max(deliveries.values(), default=burst_start) - burst_start
+  res = {
+      'users': args.users,
+      'subscriptions': args.subscriptions,
+      'posts': args.posts,
+      'expected': expected,
+      'delivered': len(deliveries),
+      'duration': duration,
+      'sends_per_second': len(deliveries) / duration if duration else 0,
+      'telegram_requests': dict(telegram.requests),
+      'telegram_errors': dict(telegram.errors),
+      'discourse_requests': dict(discourse.requests)
+  }
+  if latencies:
+    res['latency'] = {
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1]
+    }
+  print(f'delivered {len(deliveries)}/{expected} in {duration:.1f}s, '
+        f'{res["sends_per_second"]:.1f} sends/s')
+  for name, seconds in res.get('latency', {}).items():
+    print(f'latency {name:4} {seconds:8.2f}s')
+  print(f'telegram requests {res["telegram_requests"]}')
+  print(f'telegram errors   {res["telegram_errors"]}')
+  print(f'discourse requests {res["discourse_requests"]}')
+  return res
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--db',
+      required=True,
+      help='JSON file with host, user, pass and name, or conf.ini (JSON) '
+      'whose db section is used.')
+  parser.add_argument('--reset', action='store_true')
+  parser.add_argument('--users', type=int, default=1000)
+  parser.add_argument('--subscriptions', type=int, default=5000)
+  parser.add_argument('--categories', type=int, default=50)
+  parser.add_argument('--posts', type=int, default=100)
+  parser.add_argument(
+      '--blocked',
+      type=float,
+      default=0.01,
+      help='Share of the users that blocked the bot.')
+  parser.add_argument(
+      '--flood-ratio',
+      type=float,
+      default=0.01,
+      help='Share of the sends rejected with 429 regardless of the rate.')
+  parser.add_argument('--global-rate', type=float, default=30)
+  parser.add_argument('--chat-rate', type=float, default=1)
+  parser.add_argument('--workers', type=int, default=16)
+  parser.add_argument('--pool-size', type=int, default=4)
+  parser.add_argument('--poll-interval', type=float, default=1)
+  parser.add_argument('--timeout', type=float, default=600)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='Write the results to this json file.')
+  parser.add_argument('-v', '--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+  db = readDb(args.db)
+  rnd = random.Random(args.seed)
+  categories = makeCategories(args.categories)
+  courses = [c['id'] for c in categories if 'parent_category_id' in c]
+  subscribers = seed(db, args.users, args.subscriptions, courses, args.reset,
+                     rnd)
+  cids = [FIRST_CID + i for i in range(args.users)]
+  blocked = set(rnd.sample(cids, int(args.users * args.blocked)))
+
+  corpus = loadCorpus()
+  discourse = fakeDiscourse(categories, [corpus[k] for k in sorted(corpus)],
+                            args.seed)
+  discourse.addPosts(EXISTING_POSTS)
+  telegram = fakeTelegram(
+      args.global_rate,
+      args.chat_rate,
+      blocked=blocked,
+      flood_ratio=args.flood_ratio,
+      seed=args.seed)
+  tmp = tempfile.mkdtemp(prefix='cowbot-load-')
+  # Start past the existing posts, only the burst is measured.
+  with open(os.path.join(tmp, 'lpost_file'), 'w') as f:
+    f.write(str(EXISTING_POSTS))
+  bot = cowBot(makeConf(args, db, discourse, telegram, tmp), queue.Queue())
+  bot.start()
+  # Let the bot log in and load the categories before the burst.
+  time.sleep(2 * args.poll_interval)
+
+  post_ids = set(discourse.addPosts(args.posts))
+  burst_start = min(discourse.created[pid] for pid in post_ids)
+  expected = sum(
+      len(
+          subscribers.get(discourse.posts[pid]['category_id'], set()) - blocked)
+      for pid in post_ids)
+  print(f'{args.users} users, {sum(len(s) for s in subscribers.values())} '
+        f'subscriptions, {len(blocked)} blocked, {args.posts} posts, '
+        f'{expected} deliveries expected')
+  deadline = time.monotonic() + args.timeout
+  while True:
+    deliveries = delivered(telegram, post_ids)
+    if len(deliveries) >= expected or time.monotonic() > deadline:
+      break
+    time.sleep(1)
+
+  res = report(args, expected, deliveries, discourse, telegram, burst_start)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(res, f, indent=2, sort_keys=True)
+  sys.stdout.flush()
+  # The bot's threads never exit.
+  os._exit(0 if len(deliveries) >= expected else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+"""Times convertDiscourseToTelegram on the posts in benchmarks/corpus.
+
+Compares the shared, precompiled pipeline against building a new parser per
+post, which is what convertDiscourseToTelegram used to do.
+
+Usage: python benchmarks/render.py [ITERATIONS]
+"""
+import glob
+import os
+import sys
+import timeit
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+import mistune
+from markdownrenderer import (convertDiscourseToTelegram, telegramRenderer,
+                              pluginEmoji, pluginQuote)
+
+
+def loadCorpus():
+  corpus = {}
+  for path in sorted(glob.glob(os.path.join(BENCHMARKS, 'corpus', '*.md'))):
+    with open(path, encoding='utf-8') as f:
+      corpus[os.path.basename(path)[:-3]] = f.read()
+  return corpus
+
+
+def legacyConvert(content):
+  renderer = telegramRenderer()
+  renderer.reset()
+  paragraphs = mistune.markdown(
+      content, renderer=renderer, plugins=[pluginEmoji, pluginQuote])
+  return paragraphs, renderer.takeAttachments()
+
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  corpus = loadCorpus()
+  # Warm up lazily loaded state, e.g. the emoji table.
+  for content in corpus.values():
+    assert convertDiscourseToTelegram(content)[0] == legacyConvert(content)[0]
+
+  print(f'{len(corpus)} posts, {iterations} iterations')
+  total_new = total_old = 0
+  for name, content in corpus.items():
+    new_time = timeit.timeit(
+        lambda: convertDiscourseToTelegram(content),
+        number=iterations) / iterations
+    old_time = timeit.timeit(
+        lambda: legacyConvert(content), number=iterations) / iterations
+    total_new += new_time
+    total_old += old_time
+    print(f'{name:24} {new_time * 1e6:10.1f}us {old_time * 1e6:10.1f}us '
+          f'(per-call parser) x{old_time / new_time:.1f}')
+  print(f'{"total":24} {total_new * 1e6:10.1f}us {total_old * 1e6:10.1f}us '
+        f'(per-call parser) x{total_old / total_new:.1f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,166 @@
+"""Times the rendering and parsing hot paths on the posts in benchmarks/corpus.
+
+Every benchmark runs in isolation, without network or database access. Results
+are written as json so they can be compared between revisions:
+
+  python benchmarks/run.py --output base.json
+  ... change things ...
+  python benchmarks/run.py --output new.json --compare base.json
+
+With --compare the exit status is 1 if any benchmark got slower than the
+baseline by more than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, ROOT)
+from render import loadCorpus
+from escape import checkEquivalence
+from split import checkSplits
+from markdownrenderer import convertDiscourseToTelegram, escape, unescape
+from mention_manager import mentionManager
+from newsparser import newsArticle, getHumanReadableDate
+from telegrammessage import telegramMessage
+
+
+class fixtureDataBase:
+  """Stands in for dataBase, every even student number is someone's alias."""
+
+  def checkForAliases(self, aliases):
+    return {alias: [1] for alias in aliases if int(alias) % 2 == 0}
+
+
+def makeArticle(content, mention_manager):
+  return newsArticle(('student42', 'Student'), 'metu.ceng.course.140',
+                     'Benchmark post', ('2020-02-03T15:30:00.000Z', 3),
+                     'https://cow.ceng.metu.edu.tr/p/1', content,
+                     mention_manager)
+
+
+def makeBenchmarks(corpus):
+  """Returns {name: fn} of the benchmarks to run."""
+  mention_manager = mentionManager(fixtureDataBase())
+  benchmarks = {}
+  for name, content in corpus.items():
+    rendered = '\n\n'.join(convertDiscourseToTelegram(content)[0])
+    # Default arguments bind the current post to each benchmark.
+    benchmarks[f'render/{name}'] = (
+        lambda content=content: convertDiscourseToTelegram(content))
+    benchmarks[f'escape/{name}'] = lambda content=content: escape(content)
+    benchmarks[f'escape_code/{name}'] = (
+        lambda content=content: escape(content, True))
+    benchmarks[f'unescape/{name}'] = (
+        lambda rendered=rendered: unescape(rendered))
+    benchmarks[f'message/{name}'] = (
+        lambda rendered=rendered: telegramMessage(rendered, escaped=True))
+    benchmarks[f'mentions/{name}'] = (
+        lambda content=content: mention_manager.parseMentions(
+            content, 'metu.ceng.course.140'))
+    # Articles cache their rendering, so a new one is parsed every time.
+    benchmarks[f'article_parse/{name}'] = (
+        lambda content=content: makeArticle(content, mention_manager).parse())
+  benchmarks['date'] = lambda: getHumanReadableDate(
+      ('2020-02-03T15:30:00.000Z', 3))
+  return benchmarks
+
+
+def measure(fn, iterations, repeat):
+  """Returns the best time per call in seconds over repeat runs."""
+  return min(timeit.repeat(fn, number=iterations, repeat=repeat)) / iterations
+
+
+def revision():
+  try:
+    # capture_output and text need python 3.7.
+    return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                          cwd=ROOT,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip() or None
+  except Exception:
+    return None
+
+
+def compare(results, baseline, threshold):
+  """Prints the changes against baseline, returns the regressed benchmarks."""
+  regressions = []
+  for name, seconds in results.items():
+    base = baseline.get(name)
+    if base is None:
+      print(f'{name:40} {seconds * 1e6:10.1f}us {"new":>10}')
+      continue
+    change = seconds / base - 1
+    mark = ''
+    if change > threshold:
+      mark = ' REGRESSION'
+      regressions.append(name)
+    print(f'{name:40} {seconds * 1e6:10.1f}us {base * 1e6:10.1f}us '
+          f'{change:+8.1%}{mark}')
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--iterations', type=int, default=50)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument(
+      '--filter', default='', help='Only run benchmarks containing this.')
+  parser.add_argument('--output', help='Write the results to this json file.')
+  parser.add_argument('--compare', help='Baseline json file to compare to.')
+  parser.add_argument(
+      '--threshold',
+      type=float,
+      default=0.10,
+      help='Allowed slowdown against the baseline, 0.10 is 10%%.')
+  args = parser.parse_args()
+
+  # Timing a wrong implementation is pointless.
+  checkEquivalence()
+  checkSplits()
+  benchmarks = makeBenchmarks(loadCorpus())
+  # Warm up lazily loaded state, e.g. the emoji table.
+  for fn in benchmarks.values():
+    fn()
+
+  results = {}
+  for name, fn in benchmarks.items():
+    if args.filter not in name:
+      continue
+    results[name] = measure(fn, args.iterations, args.repeat)
+    if not args.compare:
+      print(f'{name:40} {results[name] * 1e6:10.1f}us')
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(
+          {
+              'revision': revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'iterations': args.iterations,
+              'repeat': args.repeat,
+              'results': results,
+          },
+          f,
+          indent=2,
+          sort_keys=True)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      print(f'{len(regressions)} regression(s) above {args.threshold:.0%}')
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,82 @@
+"""Checks splitMarkdown on edge cases and on the corpus, and times it.
+
+Every case must finish, every chunk must be non-empty and within the limit.
+Each case runs under a SIGALRM timeout, so a splitter that stops making
+progress fails instead of hanging.
+
+Usage: python benchmarks/split.py [ITERATIONS]
+"""
+import os
+import signal
+import sys
+import timeit
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+from markdownrenderer import convertDiscourseToTelegram, unescape
+from render import loadCorpus
+from telegrammessage import splitMarkdown, utf16Length
+
+# Seconds a single split may take.
+TIMEOUT = 3
+GOOGLE_DOC = 'https://docs.google.com/document/d/' + 'x' * 4200 + '/edit'
+
+# (text, limit) pairs that used to hang or produce chunks over the limit.
+CASES = [
+    # Links longer than a message, in the url and in the text.
+    ('[x](' + 'a' * 5000 + ')', 4096),
+    ('[' + 'x' * 5000 + '](a)', 4096),
+    ('[a](' + 'u' * 30 + ') ' * 200, 20),
+    # Code block openers and entities filling the whole chunk.
+    ('```' + 'p' * 5000 + '\ncode\n```', 4096),
+    ('*_~' + 'a' * 50 + '~_*', 5),
+    ('__' * 10 + 'x' * 100 + '__' * 10, 10),
+    ('`' + 'b' * 100 + '`', 3),
+    # Runs of separators longer than a message.
+    (' ' * 5000, 100),
+    ('\n' * 5000 + 'a', 100),
+]
+
+
+def timeout(*args):
+  raise TimeoutError('splitMarkdown made no progress')
+
+
+def split(text, limit):
+  signal.alarm(TIMEOUT)
+  try:
+    chunks = splitMarkdown(text, limit)
+  finally:
+    signal.alarm(0)
+  for chunk in chunks:
+    assert chunk and utf16Length(chunk) <= limit, (text[:40], limit, chunk)
+  return chunks
+
+
+def checkSplits():
+  signal.signal(signal.SIGALRM, timeout)
+  for text, limit in CASES:
+    split(text, limit)
+  # A rendered post with a link to a document, the url survives as text.
+  post = ('intro ' * 100 + f'\n\nsee [the document]({GOOGLE_DOC}) please')
+  rendered = '\n\n'.join(convertDiscourseToTelegram(post)[0])
+  assert GOOGLE_DOC in unescape(''.join(split(rendered, 4096)))
+  for content in loadCorpus().values():
+    rendered = '\n\n'.join(convertDiscourseToTelegram(content)[0])
+    for limit in (300, 1000, 4096):
+      split(rendered, limit)
+
+
+def main():
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+  checkSplits()
+  print('splitMarkdown handles every case')
+  for name, content in loadCorpus().items():
+    rendered = '\n\n'.join(convertDiscourseToTelegram(content)[0])
+    seconds = timeit.timeit(
+        lambda: splitMarkdown(rendered, 1000), number=iterations) / iterations
+    print(f'{name:24} {len(rendered):8} chars {seconds * 1e6:10.1f}us')
+
+
+if __name__ == '__main__':
+  main()
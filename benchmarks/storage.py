@@ -0,0 +1,132 @@
+"""Checks the outbox queries of dataBase against a scratch MySQL database.
+
+A post with a mention is stored through outbox.put, drained, partly failed,
+retried and deleted the way the bot does it, and the articles and outbox
+tables are checked after every step:
+
+  python benchmarks/storage.py --db conf.ini --reset
+
+The tables are created from db.sql. Like load.py, a database that already has
+rows in them is only used with --reset, which deletes every row the bot
+stores, so never point this at a production database.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import types
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+from database import dataBase
+from load import FIRST_CID, createTables, readDb
+from mention_manager import mentionManager
+from newsparser import newsArticle
+from outbox import outbox
+
+ALIAS = '123456'
+POST = 'Grades are announced\n\ne1234567\n'
+
+
+class recordingDispatcher:
+  """Stands in for the dispatcher, keeps the submitted deliveries."""
+
+  def __init__(self):
+    self.submitted = []
+
+  def submit(self, cid, article, done):
+    self.submitted.append((cid, article, done))
+
+
+def count(db, table):
+  with db.pool.connection() as conn:
+    cur = conn.cursor()
+    cur.execute(f'SELECT COUNT(*) FROM `{table}`')
+    res = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+  return res
+
+
+def expect(db, articles, deliveries):
+  res = (count(db, 'articles'), count(db, 'outbox'))
+  assert res == (articles, deliveries), res
+
+
+def checkOutbox(db):
+  assert db.registerUser(FIRST_CID, FIRST_CID, 'mentioned') == 0
+  assert db.addAlias(FIRST_CID, ALIAS) == 0
+  article = newsArticle(('student42', 'Student'), 'metu.ceng.course.140',
+                        'Grades', ('2020-02-03T15:30:00.000Z', 3),
+                        'https://cow.ceng.metu.edu.tr/p/1', POST,
+                        mentionManager(db))
+  assert len(article.getMentions()) == 1
+  dispatcher = recordingDispatcher()
+  box = outbox(types.SimpleNamespace(db=db, dispatcher=dispatcher))
+  cids = [FIRST_CID, FIRST_CID + 1, FIRST_CID + 2]
+
+  # The post and its mention are stored in one transaction.
+  assert box.put([(article, cids)])
+  expect(db, 2, 4)
+  assert box.qsize() == 4
+
+  # Articles are read back from the table, not from the cache.
+  box.articles.clear()
+  assert box.drain() == 4
+  assert len(dispatcher.submitted) == 4
+  mentions = [
+      cid for cid, delivered, _ in dispatcher.submitted
+      if 'Your alias' in delivered.getMessage().chunks[0]['text']
+  ]
+  assert mentions == [FIRST_CID], mentions
+  # The first recipient of the post fails, every other delivery is sent.
+  for i, (_, _, done) in enumerate(dispatcher.submitted):
+    done(i != 0)
+  # The mention's article goes with its only row, the post's article stays
+  # for the row that failed.
+  box.flush()
+  expect(db, 1, 1)
+  assert box.qsize() == 1
+
+  box.retry_at = 0
+  assert box.rewind()
+  del dispatcher.submitted[:]
+  assert box.drain() == 1
+  dispatcher.submitted[0][2](True)
+  box.flush()
+  expect(db, 0, 0)
+  assert box.qsize() == 0
+
+  # A failing insert leaves neither articles nor rows behind. dataBase prints
+  # the expected error.
+  with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+      io.StringIO()):
+    res = db.addDeliveries([('{}', cids), (None, cids)])
+  assert res is None
+  expect(db, 0, 0)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--db',
+      required=True,
+      help='JSON file with host, user, pass and name, or conf.ini (JSON) '
+      'whose db section is used.')
+  parser.add_argument('--reset', action='store_true')
+  args = parser.parse_args()
+
+  db = readDb(args.db)
+  conn = createTables(db, args.reset)
+  cur = conn.cursor()
+  cur.execute('SELECT VERSION()')
+  version = cur.fetchone()[0]
+  cur.close()
+  conn.close()
+  checkOutbox(dataBase(db['host'], db['user'], db['pass'], db['name'], None, 2))
+  print(f'outbox queries behave on MySQL {version}')
+
+
+if __name__ == '__main__':
+  main()
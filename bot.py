@@ -1,60 +1,154 @@
 import traceback
 import datetime
-import requests
 import sys
 import time
 import threading
 from database import dataBase
-from newsreader import newsReader
+from newsreader import newsReader, pollScheduler
 from mention_manager import mentionManager
-from markdownrenderer import escape, unescape
+from dispatcher import dispatcher
+from broadcast import broadcaster
+from outbox import outbox
+from workerpool import keyedWorkerPool
+from ratelimit import rateLimiter
+from httpsession import makeSession
+from filecache import fileIdCache, fileId
+from metrics import makeCounter, makeGauge, makeHistogram
+from telegrammessage import telegramMessage, isParseError, isPermanentError
 from logger import getLogger
 
 logger = getLogger(__name__)
 
+POLL_DURATION = makeHistogram('cow_poll_duration_seconds',
+                              'Duration of a forum poll cycle.')
+POLL_ARTICLES = makeHistogram('cow_poll_articles',
+                              'Articles in known categories built per poll.',
+                              (), (0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+TELEGRAM_LATENCY = makeHistogram('cow_telegram_request_duration_seconds',
+                                 'Latency of telegram API requests.',
+                                 ('method',))
+TELEGRAM_ERRORS = makeCounter('cow_telegram_errors_total',
+                              'Failed telegram API requests.', ('code',))
+COMMAND_DURATION = makeHistogram('cow_command_duration_seconds',
+                                 'Time spent processing a bot update.')
+
 
 class cowBot(threading.Thread):
   MAX_RETRIES = 3
+  # Telegram accepts 2 to 10 files in a media group.
+  MEDIA_GROUP_SIZE = 10
 
   def __init__(self, conf, q):
     threading.Thread.__init__(self)
     self.token = conf['bot']['token']
+    self.admin = conf['bot'].get('admin', 147926496)
     self.conf = conf
     self.q = q
-    self.rdr = newsReader(conf['news']['host'], conf['news']['port'],
-                          conf['news']['user'], conf['news']['pass'],
-                          conf['news']['last'], conf['news']['auth'],
-                          conf['news']['timezone'])
-    self.db = dataBase(conf['db']['host'], conf['db']['user'],
-                       conf['db']['pass'], conf['db']['name'], self.rdr)
-    self.mention_manager = mentionManager(self.db, self)
-
-    self.url = 'https://api.telegram.org/bot%s/' % self.token
-    self.setWebhook(conf['bot']['url'] + '%s' % self.token,
-                    conf['web']['pubkey'])
+    self.rdr = newsReader(conf['news'])
+    db_conf = conf['db']
+    self.db = dataBase(db_conf['host'], db_conf['user'], db_conf['pass'],
+                       db_conf['name'], self.rdr, db_conf.get('pool_size', 4),
+                       db_conf.get('idle_timeout', 60))
+    self.mention_manager = mentionManager(self.db)
+    dispatch_conf = conf.get('dispatch', {})
+    self.limiter = rateLimiter(
+        dispatch_conf.get('global_rate', 30), dispatch_conf.get('chat_rate', 1),
+        dispatch_conf.get('group_rate', 20 / 60.))
+    self.dispatcher = dispatcher(self, dispatch_conf.get('workers', 16),
+                                 dispatch_conf.get('queue_size', 10000))
+    outbox_conf = conf.get('outbox', {})
+    self.outbox = outbox(self, outbox_conf.get('batch_size', 500),
+                         outbox_conf.get('high_water', 20000),
+                         outbox_conf.get('cache_size', 256),
+                         outbox_conf.get('retry_delay', 30))
+    # Updates of a chat are processed in order, different chats in parallel.
+    self.commands = keyedWorkerPool('commands',
+                                    conf['bot'].get('command_workers', 8),
+                                    conf['bot'].get('queue_size', 1000))
+    broadcast_conf = conf.get('broadcast', {})
+    self.broadcaster = broadcaster(self, self.admin,
+                                   dispatch_conf.get('global_rate', 30),
+                                   broadcast_conf.get('share', 0.5),
+                                   broadcast_conf.get('batch_size', 50),
+                                   broadcast_conf.get('report_interval', 60))
+
+    # Keep-alive connections to telegram, one per dispatcher worker plus a few
+    # for command replies.
+    self.session = makeSession(dispatch_conf.get('workers', 16) + 4)
+    api = conf['bot'].get('api', 'https://api.telegram.org')
+    self.url = '%s/bot%s/' % (api, self.token)
+    self.file_ids = fileIdCache(conf['bot'].get('file_id_cache_size', 4096))
+    if conf['bot'].get('mode', 'webhook') == 'webhook':
+      self.setWebhook(conf['bot']['url'] + '%s' % self.token,
+                      conf['web']['pubkey'])
+    else:
+      # getUpdates doesn't work while a webhook is set.
+      self.makeRequest({'method': 'deleteWebhook'})
     self.registerHandlers()
     self.registerTexts()
+    self.registerMetrics()
+
+  def registerMetrics(self):
+    makeGauge('cow_command_queue_depth', 'Updates waiting to be processed.',
+              ('stage',), self.commandQueueDepth)
+    makeGauge(
+        'cow_dispatch_queue_depth',
+        'Deliveries waiting to be sent.',
+        fn=self.dispatcher.qsize)
+    makeGauge(
+        'cow_outbox_pending',
+        'Stored deliveries that are not sent yet.',
+        fn=self.outbox.qsize)
+    makeGauge(
+        'cow_subscription_index_size',
+        'Subscriptions in the in-memory index.',
+        fn=self.db.index.size)
+    makeGauge('cow_http_requests_total', 'HTTP requests sent.', ('client',),
+              lambda: self.sessionStats(0), 'counter')
+    makeGauge('cow_http_connections_total',
+              'HTTP connections opened, i.e. TCP and TLS handshakes.',
+              ('client',), lambda: self.sessionStats(1), 'counter')
+
+  def commandQueueDepth(self):
+    return {
+        ('received',): self.q.qsize(),
+        ('processing',): self.commands.qsize()
+    }
+
+  def sessionStats(self, idx):
+    sessions = {'forum': self.rdr.session, 'telegram': self.session}
+    return {(name,): s.stats.snapshot()[idx] for name, s in sessions.items()}
 
   def updateTopics(self):
+    scheduler = pollScheduler(self.conf['news'].get('poll_min_interval', 5),
+                              self.conf['news'].get('poll_max_interval', 120))
     while True:
+      start = time.monotonic()
+      new_posts = 0
       try:
-        self.db.ping()
-        entries = self.db.getTopics()
         posts = self.rdr.updatePosts(self.mention_manager)
-        for entry in entries:
-          cat_id = entry[0]
-          relevant_posts = posts.get(cat_id, [])
-          for user in entry[1]:
-            for msg in relevant_posts:
-              if not user[1] or not msg.isPlusOne():
-                self.sendArticle(user[0], msg)
+        new_posts = sum(len(p) for p in posts.values())
+        POLL_ARTICLES.observe(new_posts)
+        deliveries = []
+        for cat_id, relevant_posts in posts.items():
+          subscribers = self.db.getSubscribers(cat_id)
+          for msg in relevant_posts:
+            deliveries.append((msg, [
+                cid for cid, no_plus_one in subscribers
+                if not no_plus_one or not msg.isPlusOne()
+            ]))
+        # Blocks while too many deliveries are pending. Posts are fetched again
+        # on the next poll if they couldn't be stored.
+        if self.outbox.put(deliveries):
+          self.rdr.commitPosts()
       except Exception as e:
         logger.error('{} {}', e, datetime.datetime.now())
         traceback.print_exc()
-      time.sleep(10)
+      elapsed = time.monotonic() - start
+      POLL_DURATION.observe(elapsed)
+      time.sleep(max(0, scheduler.next(new_posts) - elapsed))
 
   def startHandler(self, data, reply=True):
-    self.db.ping()
     res = self.db.registerUser(data['uid'], data['cid'], data['uname'])
     msg = self.texts['error'].format(data['uname'])
     if res == 0:
@@ -67,7 +161,6 @@ class cowBot(threading.Thread):
       self.sendMsg(data['cid'], msg)
 
   def handlePlusOne(self, data, no_plus_one, reply=True):
-    self.db.ping()
     res = self.db.updateUser(data['uid'], no_plus_one)
     msg = self.texts['error'].format(data['uname'])
     if res == 0:
@@ -91,7 +184,6 @@ class cowBot(threading.Thread):
       return
 
     topic = ' '.join(text[1:])
-    self.db.ping()
     res, added_topic = self.db.addTopic(data['cid'], topic)
 
     msg = self.texts['error'].format(data['uname'])
@@ -107,17 +199,19 @@ class cowBot(threading.Thread):
     self.sendMsg(data['cid'], msg)
 
   def announcementHandler(self, data):
-    if data['uid'] != 147926496:
+    if data['uid'] != self.admin:
       return
 
-    text = data['txt'].split(' ')
-    if len(text) < 2:
+    text = data['txt'].split(' ', 1)
+    if len(text) < 2 or not text[1].strip():
       self.sendMsg(data['cid'], self.texts['invalid'])
       return
-    text = text[1]
 
-    for cid in self.db.getCids():
-      self.sendMsg(cid, text)
+    bid = self.broadcaster.submit(text[1])
+    msg = self.texts['error'].format(data['uname'])
+    if bid is not None:
+      msg = 'Broadcast #{} is queued'.format(bid)
+    self.sendMsg(data['cid'], msg)
 
   def deleteHandler(self, data):
     text = data['txt'].split(' ')
@@ -126,7 +220,6 @@ class cowBot(threading.Thread):
       return
 
     topic = ' '.join(text[1:])
-    self.db.ping()
     res, deleted_topic = self.db.deleteTopic(data['cid'], topic)
 
     msg = self.texts['error'].format(data['uname'])
@@ -142,7 +235,6 @@ class cowBot(threading.Thread):
     self.sendMsg(data['cid'], msg)
 
   def listHandler(self, data):
-    self.db.ping()
     res = self.db.getTopicsByCid(data['cid'])
     if res is None:
       msg = self.texts['error'].format(data['uname'])
@@ -168,7 +260,6 @@ class cowBot(threading.Thread):
     if self.mention_manager.isStudentNumber(alias) is None:
       msg = self.texts['aliasnotvalid'].format(alias)
     else:
-      self.db.ping()
       alias = self.mention_manager.getMinimalStudentNo(alias)
       res = self.db.addAlias(cid, alias)
       msg = self.texts['error'].format(data['uname'])
@@ -182,7 +273,6 @@ class cowBot(threading.Thread):
   def showAliasesHandler(self, data):
     cid = data['cid']
 
-    self.db.ping()
     aliases = self.db.getAliases(cid)
     msg = '\r\n'.join(aliases)
     if len(aliases) == 0:
@@ -190,18 +280,22 @@ class cowBot(threading.Thread):
     self.sendMsg(cid, msg)
 
   def makeRequest(self, data, depth=1):
+    res = {}
     try:
-      r = requests.post(self.url, json=data)
+      self.limiter.acquire(data.get('chat_id'))
+      start = time.monotonic()
+      r = self.session.post(self.url, json=data)
+      TELEGRAM_LATENCY.observe(time.monotonic() - start, data['method'])
       logger.debug('Request: {}', data)
       res = r.json()
       logger.debug('Response: {}', res)
       if res['ok']:
         return True, res
+      TELEGRAM_ERRORS.inc(res['error_code'])
       if res['error_code'] == 403 and res['description'] in (
           'Forbidden: bot was blocked by the user',
           'Forbidden: user is deactivated'):
         logger.info('Disabling user: {}', data['chat_id'])
-        self.db.ping()
         self.db.setUserStatus(data['chat_id'], 0)
         return False, res
       if res['error_code'] == 429 and depth < self.MAX_RETRIES:
@@ -209,7 +303,8 @@ class cowBot(threading.Thread):
         wait = params.get('retry_after')
         if wait:
           logger.info('Hit flood control, retrying in {} secs', wait)
-          time.sleep(wait)
+          # The limiter delays this retry and any other message to that chat.
+          self.limiter.penalize(data.get('chat_id'), wait)
           return self.makeRequest(data, depth + 1)
       logger.error('Req {} failed with {}', data, res)
       return False, res
@@ -227,7 +322,7 @@ class cowBot(threading.Thread):
     data['method'] = 'setWebhook'
     data['url'] = url
     files = {'certificate': open(pubkey, 'rb')}
-    resp = requests.post(self.url, data=data, files=files).json()
+    resp = self.session.post(self.url, data=data, files=files).json()
     if resp['ok'] == False:
       logger.error('Failed to set webhook {} - {}', data, resp)
       sys.exit(1)
@@ -297,44 +392,80 @@ Source is available at https://github.com/kadircet/COWNotifier
     }
 
   def sendArticle(self, cid, article):
-    self.sendMsg(cid, article.parse(), escaped=True)
-    for attachment in article.getAttachments():
-      self.sendAttachment(cid, attachment)
+    """Sends article to cid, returns False if it should be retried later."""
+    message = article.getMessage()
+    if message is None:
+      return True
+    status, res = self.sendMessage(cid, message)
+    if not status:
+      return isPermanentError(res)
+    # The message arrived, failed attachments don't warrant sending it again.
+    self.sendAttachments(cid, article.getAttachments())
+    return True
 
   def sendMsg(self, cid, text, escaped=False):
     if text is None:
       return
-    if not escaped:
-      text = escape(text)
-    data = {}
-    data['method'] = 'sendMessage'
-    data['chat_id'] = cid
-    data['parse_mode'] = 'MarkdownV2'
-    data['disable_web_page_preview'] = True
-    while len(text):
-      data['text'] = text[:4096]
-      text = text[4096:]
-      status, res = self.makeRequest(data)
+    self.sendMessage(cid, telegramMessage(text, escaped))
+
+  def sendMessage(self, cid, message):
+    """Sends the chunks of message, returns (status, response of the last)."""
+    status, res = True, {}
+    for idx, chunk in enumerate(message.chunks):
+      status, res = self.makeRequest(dict(chunk, chat_id=cid))
       # Failed to send message, try to recover.
-      if res.get('error_code') == 400 and res.get(
-          'description', '').startswith('Bad Request: can\'t parse entities:'):
-        data['text'] = unescape(data['text'])
-        # In case of a bad markdown syntax, try with plaintext.
-        del data['parse_mode']
-        status, _ = self.makeRequest(data)
-        # Restore parse_mode for remaining blocks.
-        data['parse_mode'] = 'MarkdownV2'
+      if isParseError(res):
+        # In case of a bad markdown syntax, try with plaintext. The plaintext
+        # chunk is kept in the message for the remaining recipients.
+        chunk = message.fallback(idx, chunk)
+        status, res = self.makeRequest(dict(chunk, chat_id=cid))
 
       if not status:
         break
-    return
+    return status, res
+
+  def sendAttachments(self, cid, attachments):
+    for i in range(0, len(attachments), self.MEDIA_GROUP_SIZE):
+      group = attachments[i:i + self.MEDIA_GROUP_SIZE]
+      if len(group) > 1:
+        status, res = self.sendMediaGroup(cid, group)
+        # A file telegram can't fetch fails the whole group, send the files
+        # one by one so the others still arrive.
+        if status or res.get('error_code') != 400:
+          continue
+      for attachment in group:
+        self.sendAttachment(cid, attachment)
+
+  def sendMediaGroup(self, cid, attachments):
+    data = {}
+    data['method'] = 'sendMediaGroup'
+    data['chat_id'] = cid
+    data['media'] = [{
+        'type': 'document',
+        'media': self.file_ids.get(a.url) or a.url
+    } for a in attachments]
+    status, res = self.makeRequest(data)
+    if status:
+      for attachment, msg in zip(attachments, res['result']):
+        self.file_ids.put(attachment.url, fileId(msg))
+    return status, res
 
   def sendAttachment(self, cid, attachment):
     data = {}
     data['method'] = 'sendDocument'
     data['chat_id'] = cid
-    data['document'] = attachment.url
-    self.makeRequest(data)
+    # Reuse the file of an earlier upload, so telegram doesn't download it
+    # from the forum again.
+    file_id = self.file_ids.get(attachment.url)
+    data['document'] = file_id or attachment.url
+    status, res = self.makeRequest(data)
+    if not status and file_id is not None and res.get('error_code') == 400:
+      self.file_ids.invalidate(attachment.url)
+      data['document'] = attachment.url
+      status, res = self.makeRequest(data)
+    if status:
+      self.file_ids.put(attachment.url, fileId(res['result']))
+    return status
 
   def parse(self, data):
     res = {}
@@ -390,14 +521,33 @@ Source is available at https://github.com/kadircet/COWNotifier
       self.handlers['start'](data, False)
     self.handlers[cmd](data)
 
+  def chatId(self, data):
+    msg = data.get('message', data.get('edited_message', {}))
+    return msg.get('chat', {}).get('id')
+
+  def processUpdate(self, data):
+    start = time.monotonic()
+    try:
+      self.process(data)
+    finally:
+      COMMAND_DURATION.observe(time.monotonic() - start)
+      # Lets the update poller confirm a batch once it is processed.
+      self.q.task_done()
+
   def run(self):
     threading.Thread(target=self.updateTopics).start()
+    self.broadcaster.start()
+    self.outbox.start()
     while True:
+      data = self.q.get()
       try:
-        data = self.q.get()
-        self.process(data)
+        # Blocks while the pool is full, which in turn fills up self.q and
+        # makes the webhook ask telegram to retry later.
+        self.commands.submit(self.chatId(data), self.processUpdate, data)
       except Exception as e:
         logger.error('{}', e)
         traceback.print_exc()
+        # processUpdate won't run for it, the update poller waits on q.join.
+        self.q.task_done()
       sys.stdout.flush()
       sys.stderr.flush()
@@ -0,0 +1,108 @@
+import datetime
+import threading
+import time
+import traceback
+from ratelimit import tokenBucket
+from telegrammessage import telegramMessage
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class broadcaster(threading.Thread):
+  """Delivers announcements to every active user in the background.
+
+  Broadcasts are stored in the database together with a cursor, the last cid
+  handled, which is saved after every batch so an interrupted broadcast is
+  resumed where it left off after a restart. Sends are throttled to share of
+  the global telegram rate, leaving the rest to article deliveries and command
+  replies.
+  """
+
+  def __init__(self,
+               bot,
+               admin,
+               global_rate=30,
+               share=0.5,
+               batch_size=50,
+               report_interval=60):
+    threading.Thread.__init__(self, daemon=True)
+    self.bot = bot
+    self.db = bot.db
+    self.admin = admin
+    rate = max(global_rate * share, 0.1)
+    self.bucket = tokenBucket(rate, 1)
+    self.batch_size = batch_size
+    self.report_interval = report_interval
+    self.wakeup = threading.Event()
+
+  def submit(self, text):
+    """Queues text for every active user, returns the broadcast id or None."""
+    bid = self.db.addBroadcast(text)
+    if bid is not None:
+      self.wakeup.set()
+    return bid
+
+  def report(self, bid, total, sent, failed, done=False):
+    state = 'finished' if done else 'in progress'
+    self.bot.sendMsg(
+        self.admin, 'Broadcast #{} {}: {} sent, {} failed, {} users'.format(
+            bid, state, sent, failed, total))
+
+  def deliver(self, job):
+    bid, text, last_cid, total, sent, failed = job
+    # Rendered once, a plaintext fallback is kept for the remaining users.
+    message = telegramMessage(text)
+    last_report = time.monotonic()
+    while True:
+      cids = self.db.getBroadcastCids(last_cid, self.batch_size)
+      if cids is None:
+        return False
+      if not cids:
+        break
+      for cid in cids:
+        wait = self.bucket.reserve()
+        if wait > 0:
+          time.sleep(wait)
+        status, _ = self.bot.sendMessage(cid, message)
+        if status:
+          sent += 1
+        else:
+          failed += 1
+      last_cid = cids[-1]
+      if self.db.updateBroadcast(bid, last_cid, sent, failed) != 0:
+        return False
+      if time.monotonic() - last_report >= self.report_interval:
+        last_report = time.monotonic()
+        self.report(bid, total, sent, failed)
+    if self.db.updateBroadcast(bid, last_cid, sent, failed, True) != 0:
+      return False
+    self.report(bid, total, sent, failed, True)
+    return True
+
+  def run(self):
+    backoff = 1
+    while True:
+      self.wakeup.clear()
+      ok = True
+      try:
+        jobs = self.db.getPendingBroadcasts()
+        if jobs is None:
+          ok = False
+        else:
+          for job in jobs:
+            logger.info('Delivering broadcast #{}', job[0])
+            if not self.deliver(job):
+              ok = False
+              break
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
+        ok = False
+      if ok:
+        backoff = 1
+        self.wakeup.wait()
+      else:
+        logger.error('Retrying broadcasts in {} seconds', backoff)
+        time.sleep(backoff)
+        backoff = min(60, backoff * 2)
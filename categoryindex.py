@@ -0,0 +1,57 @@
+class categoryIndex:
+  """Read-only lookup tables for the forum's categories.
+
+  Built from the categories list of site.json. A category's name is the dotted
+  path of its ancestors' names, e.g. 'metu.ceng.course.100'. The index is never
+  modified after construction, a refresh builds a new one and replaces the old
+  reference, so readers never see a half built index.
+  """
+
+  def __init__(self, categories=()):
+    raw = {}
+    parents = {}
+    for item in categories:
+      raw[item['id']] = item['name']
+      parents[item['id']] = item.get('parent_category_id', None)
+
+    # id -> tuple of category ids from the root down to id.
+    self.ancestors = {}
+    for cat_id in raw:
+      self.chain(cat_id, parents, raw)
+
+    self.names = {}
+    for cat_id, chain in self.ancestors.items():
+      self.names[cat_id] = '.'.join(raw[i] for i in chain)
+    self.ids = {name: cat_id for cat_id, name in self.names.items()}
+    self.folded = {
+        name.casefold(): cat_id for cat_id, name in self.names.items()
+    }
+
+  def chain(self, cat_id, parents, raw):
+    """Memoized ancestor chain, each category is only resolved once."""
+    chain = self.ancestors.get(cat_id)
+    if chain is not None:
+      return chain
+    # Guards against cycles, the category is treated as a root.
+    self.ancestors[cat_id] = (cat_id,)
+    parent = parents.get(cat_id)
+    if parent is not None and parent in raw:
+      self.ancestors[cat_id] = self.chain(parent, parents, raw) + (cat_id,)
+    return self.ancestors[cat_id]
+
+  def __contains__(self, cat_id):
+    return cat_id in self.names
+
+  def __len__(self):
+    return len(self.names)
+
+  def name(self, cat_id, default=None):
+    return self.names.get(cat_id, default)
+
+  def getId(self, name):
+    """Returns the id of the category called name, -1 if there is none."""
+    return self.ids.get(name, -1)
+
+  def find(self, name):
+    """Case insensitive version of getId."""
+    return self.folded.get(name.casefold(), -1)
@@ -1,100 +1,303 @@
+import contextlib
+import time
 import traceback
 import threading
 import MySQLdb
 import datetime
 
 
-class dataBase:
+class connectionPool:
+  """Thread-safe pool of MySQLdb connections.
 
-  def __init__(self, host, uname, pw, dbname, rdr):
-    self.conn = MySQLdb.connect(host, uname, pw, dbname, charset="utf8mb4")
-    self.params = [host, uname, pw, dbname]
-    self.rdr = rdr
-    self.lock = threading.Lock()
+  At most size connections are open at once, callers block while all of them
+  are in use. Connections are only pinged when they were idle for longer than
+  idle_timeout seconds, connections that failed a query are replaced.
+  """
 
-  def close(self):
-    self.conn.close()
+  def __init__(self, params, size=4, idle_timeout=60):
+    self.params = params
+    self.size = size
+    self.idle_timeout = idle_timeout
+    # (conn, last use) pairs, most recently used last. Those are the least
+    # likely to have timed out on the server side.
+    self.idle = []
+    self.created = 0
+    self.broken = set()
+    self.cond = threading.Condition()
 
-  def ping(self):
-    try:
-      self.conn.ping()
-      return
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
+  def connect(self):
     backoff = 1
     while True:
       try:
-        self.conn = MySQLdb.connect(
+        return MySQLdb.connect(
             self.params[0],
             self.params[1],
             self.params[2],
             self.params[3],
-            charset="utf8")
+            charset="utf8mb4")
       except Exception as e:
         print(e, datetime.datetime.now())
         traceback.print_exc()
         time.sleep(backoff)
         backoff = min(60, backoff * 2)
 
-  def registerUser(self, uid, cid, uname):
-    sql = "INSERT INTO `users` (uid, cid, uname) VALUES (%s,%s,%s)"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
+  def discard(self, conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+    with self.cond:
+      self.created -= 1
+      self.cond.notify()
+
+  def acquire(self):
+    while True:
+      with self.cond:
+        while not self.idle and self.created >= self.size:
+          self.cond.wait()
+        if not self.idle:
+          self.created += 1
+          break
+        conn, stamp = self.idle.pop()
+      if time.monotonic() - stamp < self.idle_timeout:
+        return conn
+      try:
+        conn.ping()
+        return conn
+      except Exception as e:
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+      self.discard(conn)
+    try:
+      return self.connect()
+    except:
+      with self.cond:
+        self.created -= 1
+        self.cond.notify()
+      raise
+
+  def release(self, conn):
+    with self.cond:
+      if id(conn) not in self.broken:
+        self.idle.append((conn, time.monotonic()))
+        self.cond.notify()
+        return
+      self.broken.discard(id(conn))
+    self.discard(conn)
+
+  def rollback(self, conn):
+    """Rolls back a failed transaction, conn may be too broken to do so."""
     try:
-      cur.execute(sql, (
-          uid,
-          cid,
-          uname,
-      ))
-    except MySQLdb.IntegrityError:
-      res = 1
+      conn.rollback()
     except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 2
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+      self.check(conn, e)
+
+  def check(self, conn, e):
+    """Marks conn for replacement if e means the connection is unusable."""
+    if isinstance(e, MySQLdb.OperationalError):
+      with self.cond:
+        self.broken.add(id(conn))
+
+  @contextlib.contextmanager
+  def connection(self):
+    conn = self.acquire()
+    try:
+      yield conn
+    except Exception as e:
+      self.check(conn, e)
+      raise
+    finally:
+      self.release(conn)
+
+  def close(self):
+    with self.cond:
+      idle, self.idle = self.idle, []
+    for conn, _ in idle:
+      self.discard(conn)
+
+
+def bit(value):
+  """Converts a BIT column value, returned as bytes by MySQLdb, into a bool."""
+  if isinstance(value, bytes):
+    return bool(value[0])
+  return bool(value)
+
+
+class subscriptionIndex:
+  """In-memory mirror of the users and topics tables used for dispatching.
+
+  Kept up to date write-through by dataBase, so finding the subscribers of a
+  category doesn't hit the database.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # cid -> [uid, no_plus_one, is_active]
+    self.users = {}
+    # uid -> cid, users table is updated by uid.
+    self.uids = {}
+    # category_id -> set of cids
+    self.topics = {}
+
+  def load(self, rows):
+    """Builds the index from (uid, cid, no_plus_one, is_active, topic) rows."""
+    users = {}
+    uids = {}
+    topics = {}
+    for uid, cid, no_plus_one, is_active, topic in rows:
+      users[cid] = [uid, bit(no_plus_one), bit(is_active)]
+      uids[uid] = cid
+      if topic is not None:
+        topics.setdefault(int(topic), set()).add(cid)
+    with self.lock:
+      self.users = users
+      self.uids = uids
+      self.topics = topics
+
+  def addUser(self, uid, cid):
+    with self.lock:
+      self.users[cid] = [uid, False, True]
+      self.uids[uid] = cid
+
+  def updateUser(self, uid, no_plus_one=None, is_active=None):
+    with self.lock:
+      user = self.users.get(self.uids.get(uid))
+      if user is None:
+        return
+      if no_plus_one is not None:
+        user[1] = bool(no_plus_one)
+      if is_active is not None:
+        user[2] = bool(is_active)
+
+  def addTopic(self, cid, topic):
+    with self.lock:
+      self.topics.setdefault(topic, set()).add(cid)
+
+  def deleteTopic(self, cid, topic):
+    with self.lock:
+      cids = self.topics.get(topic)
+      if cids is not None:
+        cids.discard(cid)
+        if not cids:
+          del self.topics[topic]
+
+  def subscribers(self, topic):
+    """Returns [(cid, no_plus_one)] of active users following topic."""
+    with self.lock:
+      res = []
+      for cid in self.topics.get(topic, ()):
+        user = self.users.get(cid)
+        if user is not None and user[2]:
+          res.append((cid, user[1]))
+      return res
+
+  def size(self):
+    with self.lock:
+      return sum(len(cids) for cids in self.topics.values())
+
+
+class dataBase:
+
+  def __init__(self,
+               host,
+               uname,
+               pw,
+               dbname,
+               rdr,
+               pool_size=4,
+               idle_timeout=60):
+    self.pool = connectionPool([host, uname, pw, dbname], pool_size,
+                               idle_timeout)
+    self.rdr = rdr
+    self.index = subscriptionIndex()
+    self.loadIndex()
+    # alias -> set of cids, None if it couldn't be loaded.
+    self.aliases = None
+    self.alias_lock = threading.Lock()
+    self.loadAliases()
+
+  def loadIndex(self):
+    sql = ("SELECT `users`.`uid`, `users`.`cid`, `users`.`no_plus_one`, "
+           "`users`.`is_active`, `topics`.`topic` FROM `users` LEFT JOIN "
+           "`topics` ON `topics`.`cid`=`users`.`cid`")
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      cur.execute(sql)
+      self.index.load(cur.fetchall())
+      conn.commit()
+      cur.close()
+
+  def close(self):
+    self.pool.close()
+
+  def registerUser(self, uid, cid, uname):
+    sql = "INSERT INTO `users` (uid, cid, uname) VALUES (%s,%s,%s)"
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (
+            uid,
+            cid,
+            uname,
+        ))
+        conn.commit()
+      except MySQLdb.IntegrityError:
+        self.pool.rollback(conn)
+        res = 1
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 2
+      cur.close()
+    if res == 0:
+      self.index.addUser(uid, cid)
     return res
 
   def setUserStatus(self, uid, status):
     sql = "UPDATE `users` SET `is_active`=%s WHERE `uid`=%s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
-    try:
-      cur.execute(sql, (
-          status,
-          uid,
-      ))
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 1
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (
+            status,
+            uid,
+        ))
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 1
+      cur.close()
+    if res == 0:
+      self.index.updateUser(uid, is_active=status)
     return res
 
   def updateUser(self, uid, no_plus_one):
     sql = "UPDATE `users` SET `no_plus_one`=%s WHERE `uid`=%s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
-    try:
-      cur.execute(sql, (
-          no_plus_one,
-          uid,
-      ))
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 1
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (
+            no_plus_one,
+            uid,
+        ))
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 1
+      cur.close()
+    if res == 0:
+      self.index.updateUser(uid, no_plus_one=no_plus_one)
     return res
 
   def addTopic(self, cid, topic):
@@ -109,23 +312,27 @@ class dataBase:
     if cat_id == -1:
       return (2, topic)
     sql = "INSERT INTO `topics` (cid, topic) VALUES (%s, %s)"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
-    try:
-      cur.execute(sql, (
-          cid,
-          cat_id,
-      ))
-    except MySQLdb.IntegrityError:
-      res = 1
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 3
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (
+            cid,
+            cat_id,
+        ))
+        conn.commit()
+      except MySQLdb.IntegrityError:
+        self.pool.rollback(conn)
+        res = 1
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 3
+      cur.close()
+    if res == 0:
+      self.index.addTopic(cid, cat_id)
     return (res, topic)
 
   def deleteTopic(self, cid, topic):
@@ -140,143 +347,350 @@ class dataBase:
     if cat_id == -1:
       return (2, topic)
     sql = "DELETE FROM `topics` WHERE cid=%s AND topic=%s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
-    try:
-      cnt = cur.execute(sql, (
-          cid,
-          cat_id,
-      ))
-      if cnt == 0:
-        res = 1
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 3
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cnt = cur.execute(sql, (
+            cid,
+            cat_id,
+        ))
+        if cnt == 0:
+          res = 1
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 3
+      cur.close()
+    if res == 0:
+      self.index.deleteTopic(cid, cat_id)
     return (res, topic)
 
-  def getCids(self):
-    sql = "SELECT `cid` FROM `users`"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = []
-    try:
-      cur.execute(sql)
-      for row in cur:
-        res.append(row[0])
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = None
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
-    return res
-
   def getTopicsByCid(self, cid):
     sql = "SELECT topic FROM `topics` WHERE cid=%s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = []
-    try:
-      cur.execute(sql, (cid,))
-      for row in cur:
-        try:
-          res.append(self.rdr.categories.get(int(row[0]), ""))
-        except:
-          continue
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = None
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        cur.execute(sql, (cid,))
+        for row in cur:
+          try:
+            res.append(self.rdr.categories.get(int(row[0]), ""))
+          except:
+            continue
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
     return res
 
-  def getTopics(self):
-    sql = "SELECT topic FROM `topics` GROUP BY topic"
-    sql2 = ("SELECT `users`.`cid`, `users`.`no_plus_one` FROM `topics`, `users`"
-            " WHERE `topics`.`topic`=%s and `topics`.`cid`=`users`.`cid` and "
-            "`users`.`is_active`=1")
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    cur2 = self.conn.cursor()
-    res = []
-    try:
-      cur.execute(sql)
-      for row in cur:
-        cur2.execute(sql2, (row[0],))
-        users = []
-        for user in cur2:
-          _user = (user[0], bool(user[1][0]))
-          users.append(_user)
-        topic = row[0]
-        try:
-          topic = int(topic)
-        except e:
-          pass
-        res.append([topic, users])
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = None
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
-    return res
+  def getSubscribers(self, topic):
+    """Returns [(cid, no_plus_one)] of active users following topic."""
+    return self.index.subscribers(topic)
 
-  def checkForAlias(self, alias):
-    sql = "SELECT `cid` FROM `aliases` WHERE `alias` = %s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = []
-    try:
-      cur.execute(sql, (alias,))
-      for row in cur:
-        res.append(row[0])
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = None
-    cur.close()
-    self.lock.release()
+  def loadAliases(self):
+    sql = "SELECT `alias`, `cid` FROM `aliases`"
+    aliases = {}
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      try:
+        cur.execute(sql)
+        for row in cur:
+          aliases.setdefault(row[0], set()).add(row[1])
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        aliases = None
+      cur.close()
+    with self.alias_lock:
+      self.aliases = aliases
+
+  def checkForAliases(self, aliases):
+    """Returns {alias: [cid]} for the registered ones among aliases.
+
+    Served from the in-memory alias index, falls back to a single query if the
+    index couldn't be loaded. Returns None on failure.
+    """
+    aliases = set(aliases)
+    with self.alias_lock:
+      if self.aliases is not None:
+        return {
+            alias: list(self.aliases[alias])
+            for alias in aliases
+            if alias in self.aliases
+        }
+    if not aliases:
+      return {}
+    sql = "SELECT `alias`, `cid` FROM `aliases` WHERE `alias` IN ({})".format(
+        ', '.join(['%s'] * len(aliases)))
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = {}
+      try:
+        cur.execute(sql, tuple(aliases))
+        for row in cur:
+          res.setdefault(row[0], []).append(row[1])
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
     return res
 
   def addAlias(self, cid, alias):
     sql = "INSERT INTO `aliases` (`cid`, `alias`) VALUES (%s, %s)"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = 0
-    try:
-      cur.execute(sql, (cid, alias))
-    except MySQLdb.IntegrityError:
-      res = 1
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-      res = 2
-    self.conn.commit()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (cid, alias))
+        conn.commit()
+      except MySQLdb.IntegrityError:
+        self.pool.rollback(conn)
+        res = 1
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 2
+      cur.close()
+    if res == 0:
+      with self.alias_lock:
+        if self.aliases is not None:
+          self.aliases.setdefault(alias, set()).add(cid)
     return res
 
   def getAliases(self, cid):
     sql = "SELECT `alias` FROM `aliases` WHERE `cid` = %s"
-    self.lock.acquire()
-    cur = self.conn.cursor()
-    res = []
-    try:
-      cur.execute(sql, (cid,))
-      for row in cur:
-        res.append(row[0])
-    except Exception as e:
-      print(e, datetime.datetime.now())
-      traceback.print_exc()
-    cur.close()
-    self.lock.release()
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        cur.execute(sql, (cid,))
+        for row in cur:
+          res.append(row[0])
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+      cur.close()
+    return res
+
+  def addBroadcast(self, text):
+    """Stores a broadcast to every active user, returns its id or None."""
+    sql = ("INSERT INTO `broadcasts` (`text`, `total`) SELECT %s, COUNT(*) "
+           "FROM `users` WHERE `is_active`=1")
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = None
+      try:
+        cur.execute(sql, (text,))
+        bid = cur.lastrowid
+        conn.commit()
+        res = bid
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+      cur.close()
+    return res
+
+  def getPendingBroadcasts(self):
+    """Returns [(id, text, last_cid, total, sent, failed)] oldest first."""
+    sql = ("SELECT `id`, `text`, `last_cid`, `total`, `sent`, `failed` FROM "
+           "`broadcasts` WHERE `done`=0 ORDER BY `id`")
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        cur.execute(sql)
+        res = list(cur.fetchall())
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
+    return res
+
+  def getBroadcastCids(self, last_cid, limit):
+    """Returns the next limit active cids after last_cid, in cid order."""
+    sql = "SELECT `cid` FROM `users` WHERE `is_active`=1"
+    params = ()
+    if last_cid is not None:
+      sql += " AND `cid`>%s"
+      params = (last_cid,)
+    sql += " ORDER BY `cid` LIMIT %s"
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        cur.execute(sql, params + (limit,))
+        for row in cur:
+          res.append(row[0])
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
+    return res
+
+  def updateBroadcast(self, bid, last_cid, sent, failed, done=False):
+    sql = ("UPDATE `broadcasts` SET `last_cid`=%s, `sent`=%s, `failed`=%s, "
+           "`done`=%s WHERE `id`=%s")
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(sql, (last_cid, sent, failed, done, bid))
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 1
+      cur.close()
+    return res
+
+  def addDeliveries(self, articles):
+    """Stores articles and their pending deliveries in a single transaction.
+
+    articles is a list of (payload, cids) pairs. Returns the ids of the stored
+    articles in the same order, or None on failure.
+    """
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        rows = []
+        for payload, cids in articles:
+          cur.execute("INSERT INTO `articles` (`payload`) VALUES (%s)",
+                      (payload,))
+          res.append(cur.lastrowid)
+          rows.extend((cid, cur.lastrowid) for cid in cids)
+        cur.executemany(
+            "INSERT INTO `outbox` (`cid`, `article`) VALUES (%s, %s)", rows)
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
+    return res
+
+  def getDeliveries(self, after, limit):
+    """Returns up to limit [(id, cid, article)] outbox rows after id after."""
+    sql = ("SELECT `id`, `cid`, `article` FROM `outbox` WHERE `id`>%s "
+           "ORDER BY `id` LIMIT %s")
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = []
+      try:
+        cur.execute(sql, (after, limit))
+        res = list(cur.fetchall())
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
+    return res
+
+  def getArticles(self, ids):
+    """Returns {id: payload} for the given article ids, None on failure."""
+    ids = set(ids)
+    if not ids:
+      return {}
+    sql = "SELECT `id`, `payload` FROM `articles` WHERE `id` IN ({})".format(
+        ', '.join(['%s'] * len(ids)))
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = {}
+      try:
+        cur.execute(sql, tuple(ids))
+        for row in cur:
+          res[row[0]] = row[1]
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = None
+      cur.close()
+    return res
+
+  def deleteDeliveries(self, ids):
+    """Deletes outbox rows, and their articles once no rows refer to them.
+
+    Both happen in a single transaction. Returns 0 on success.
+    """
+    marks = ', '.join(['%s'] * len(ids))
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = 0
+      try:
+        cur.execute(
+            "SELECT DISTINCT `article` FROM `outbox` WHERE `id` IN ({})".format(
+                marks), tuple(ids))
+        articles = [row[0] for row in cur.fetchall()]
+        cur.execute("DELETE FROM `outbox` WHERE `id` IN ({})".format(marks),
+                    tuple(ids))
+        if articles:
+          cur.execute(
+              "DELETE FROM `articles` WHERE `id` IN ({}) AND NOT EXISTS "
+              "(SELECT 1 FROM `outbox` WHERE `outbox`.`article`=`articles`.`id`)"
+              .format(', '.join(['%s'] * len(articles))), tuple(articles))
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+        res = 1
+      cur.close()
+    return res
+
+  def countDeliveries(self):
+    sql = "SELECT COUNT(*) FROM `outbox`"
+    with self.pool.connection() as conn:
+      cur = conn.cursor()
+      res = None
+      try:
+        cur.execute(sql)
+        res = cur.fetchone()[0]
+        conn.commit()
+      except Exception as e:
+        self.pool.check(conn, e)
+        print(e, datetime.datetime.now())
+        traceback.print_exc()
+        self.pool.rollback(conn)
+      cur.close()
     return res
@@ -25,3 +25,30 @@ CREATE TABLE IF NOT EXISTS `aliases` (
   primary key(`id`),
   unique `ident` (`cid`, `alias`)
 );
+
+CREATE TABLE IF NOT EXISTS `broadcasts` (
+  `id` int not null auto_increment,
+  `text` text not null,
+  `last_cid` int default null,
+  `total` int not null default 0,
+  `sent` int not null default 0,
+  `failed` int not null default 0,
+  `done` BIT not null default 0,
+  `created` timestamp not null default current_timestamp,
+  primary key(`id`)
+);
+
+CREATE TABLE IF NOT EXISTS `articles` (
+  `id` int not null auto_increment,
+  `payload` mediumtext not null,
+  `created` timestamp not null default current_timestamp,
+  primary key(`id`)
+);
+
+CREATE TABLE IF NOT EXISTS `outbox` (
+  `id` int not null auto_increment,
+  `cid` int not null,
+  `article` int not null,
+  primary key(`id`),
+  foreign key(`article`) references articles(`id`)
+);
@@ -0,0 +1,36 @@
+from workerpool import keyedWorkerPool
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class dispatcher:
+  """Fans out new articles to subscribers on a bounded worker pool.
+
+  Jobs are keyed by chat id, so a chat receives its articles in the order they
+  were submitted while different chats are served in parallel. Rate limiting
+  happens in cowBot.makeRequest, workers simply block on their tokens.
+  """
+
+  def __init__(self, bot, workers=16, maxsize=10000):
+    self.bot = bot
+    self.pool = keyedWorkerPool('dispatcher', workers, maxsize)
+
+  def submit(self, cid, article, done=None):
+    """Queues article for cid.
+
+    done(settled) is called once it was handled, settled is False if sending
+    failed in a way that is worth retrying later.
+    """
+    self.pool.submit(cid, self.deliver, cid, article, done)
+
+  def deliver(self, cid, article, done):
+    settled = False
+    try:
+      settled = self.bot.sendArticle(cid, article)
+    finally:
+      if done is not None:
+        done(settled)
+
+  def qsize(self):
+    return self.pool.qsize()
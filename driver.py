@@ -7,17 +7,47 @@ import logging
 
 from bot import cowBot
 from server import webHook
+from asyncserver import asyncWebHook
+from updatepoller import updatePoller
+from markdownrenderer import setEmojiOverride
+from metrics import metricsServer
 from logger import getLogger
 
 logger = getLogger(__name__)
 
+CONF = 'conf.ini'
+
 
 def getConf(storage):
   if os.path.exists(storage):
     return json.loads(open(storage, 'r').read())
   conf = {}
-  conf['bot'] = {'token': 'BOTTOKEN', 'url': 'https://example.com:8443/'}
-  conf['web'] = {'cert': 'CERTFILE', 'pubkey': 'PUBKEYFILE'}
+  conf['bot'] = {
+      'token': 'BOTTOKEN',
+      'url': 'https://example.com:8443/',
+      'api': 'https://api.telegram.org',  # Bot API server
+      'mode': 'webhook',  # Or 'polling' to use getUpdates without a server
+      'offset_file': 'update_offset',  # Only used in polling mode
+      'poll_timeout': 50,
+      'admin': 147926496,  # uid allowed to send announcements
+      'file_id_cache_size': 4096,  # Uploaded attachments to reuse
+      'command_workers': 8,
+      'queue_size': 1000  # Updates waiting to be processed
+  }
+  conf['web'] = {
+      'cert': 'CERTFILE',
+      'pubkey': 'PUBKEYFILE',
+      'port': 8443,
+      'mode': 'threaded',  # Or 'asyncio' for a single threaded event loop
+      'max_connections': 64,  # Only used by the asyncio server
+      'max_body': 1 << 20,
+      'keepalive_timeout': 30
+  }
+  conf['metrics'] = {
+      'host': '127.0.0.1',  # Metrics aren't authenticated, keep them private
+      'port': 9100,  # 0 to disable the metrics endpoint
+      'path': '/metrics'
+  }
   conf['news'] = {
       'host': 'HOST',
       'auth': 'HOST',
@@ -25,13 +55,42 @@ def getConf(storage):
       'user': 'UNAME',
       'pass': 'PASS',
       'last': 'lpost_file',
-      'timezone': 3  # Timezone difference to UTC-Z in the form of: x or -x
+      'timezone': 3,  # Timezone difference to UTC-Z in the form of: x or -x
+      'topic_cache': 'topic_cache.json',
+      'topic_cache_size': 10000,
+      'topic_cache_ttl': 6 * 60 * 60,  # Seconds
+      'fetch_mode': 'listing',  # Or 'posts' to fetch every post by id
+      'fetch_concurrency': 8,
+      'serial_fetch': False,  # Fetch posts one by one for strict forums
+      'poll_min_interval': 5,  # Seconds between polls while posts arrive
+      'poll_max_interval': 120,  # Upper bound of the backoff when idle
+      'category_refresh_interval': 3600  # Seconds between category updates
+  }
+  conf['dispatch'] = {
+      'workers': 16,
+      'queue_size': 10000,
+      'global_rate': 30,  # Messages per second over all chats
+      'chat_rate': 1,  # Messages per second to a single private chat
+      'group_rate': 20 / 60.  # Messages per second to a single group
+  }
+  conf['broadcast'] = {
+      'share': 0.5,  # Share of the global rate used by announcements
+      'batch_size': 50,  # Users sent to between saving the cursor
+      'report_interval': 60  # Seconds between progress reports to the admin
+  }
+  conf['outbox'] = {
+      'batch_size': 500,  # Deliveries read or deleted at once
+      'high_water': 20000,  # Pending deliveries before polling is paused
+      'cache_size': 256,  # Articles kept in memory
+      'retry_delay': 30  # Seconds before failed deliveries are sent again
   }
   conf['db'] = {
       'host': 'HOST',
       'user': 'USER',
       'pass': 'PASS',
-      'name': 'DBNAME'
+      'name': 'DBNAME',
+      'pool_size': 4,
+      'idle_timeout': 60  # Seconds before an idle connection is pinged
   }
   with open(storage, 'w') as f:
     json.dump(conf, f)
@@ -40,10 +99,25 @@ def getConf(storage):
 
 def main():
   try:
-    conf = getConf('conf.ini')
-    q = queue.Queue()
+    conf = getConf(CONF)
+    setEmojiOverride(
+        os.path.join(
+            os.path.dirname(os.path.abspath(CONF)), 'emoji_override.tsv'))
+    q = queue.Queue(conf['bot'].get('queue_size', 1000))
     bot = cowBot(conf, q)
-    wh = webHook(conf, q)
+    if conf['bot'].get('mode', 'webhook') == 'polling':
+      wh = updatePoller(conf, bot, q)
+    elif conf['web'].get('mode', 'threaded') == 'asyncio':
+      wh = asyncWebHook(conf, q)
+    else:
+      wh = webHook(conf, q)
+    # conf.ini files written before the metrics section use the defaults.
+    metrics_conf = conf.get('metrics', {})
+    port = int(metrics_conf.get('port', 9100))
+    if port:
+      metricsServer(
+          metrics_conf.get('host', '127.0.0.1'), port,
+          metrics_conf.get('path', '/metrics')).start()
     bot.start()
     wh.start()
     bot.join()
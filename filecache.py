@@ -0,0 +1,50 @@
+import collections
+import threading
+
+# Fields of a telegram Message that hold a sent file.
+FILE_FIELDS = ('document', 'animation', 'video', 'audio', 'photo')
+
+
+def fileId(message):
+  """Returns the file_id of the file in a sent telegram Message, or None."""
+  for field in FILE_FIELDS:
+    media = message.get(field)
+    if media:
+      # Photos come in several sizes, the last one is the original.
+      if isinstance(media, list):
+        media = media[-1]
+      return media.get('file_id')
+  return None
+
+
+class fileIdCache:
+  """Bounded LRU cache of attachment url -> telegram file_id.
+
+  Telegram downloads a file sent by url on every request, a file_id of an
+  earlier upload is sent without touching the forum again.
+  """
+
+  def __init__(self, capacity=4096):
+    self.capacity = capacity
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, url):
+    with self.lock:
+      file_id = self.entries.get(url)
+      if file_id is not None:
+        self.entries.move_to_end(url)
+      return file_id
+
+  def put(self, url, file_id):
+    if file_id is None:
+      return
+    with self.lock:
+      self.entries[url] = file_id
+      self.entries.move_to_end(url)
+      while len(self.entries) > self.capacity:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, url):
+    with self.lock:
+      self.entries.pop(url, None)
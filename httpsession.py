@@ -0,0 +1,76 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class connectionStats:
+  """Counts requests and the connections opened to serve them."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.connections = 0
+
+  def request(self):
+    with self.lock:
+      self.requests += 1
+
+  def newConnection(self):
+    with self.lock:
+      self.connections += 1
+
+  def snapshot(self):
+    """Returns (requests, new connections, reused connections)."""
+    with self.lock:
+      return (self.requests, self.connections,
+              max(0, self.requests - self.connections))
+
+
+def countingPool(cls, stats):
+
+  class pool(cls):
+
+    def _new_conn(self):
+      stats.newConnection()
+      return super(pool, self)._new_conn()
+
+  return pool
+
+
+class countingAdapter(HTTPAdapter):
+  """HTTPAdapter that reports new connections (TCP+TLS handshakes) to stats."""
+
+  def __init__(self, stats, **kwargs):
+    self.stats = stats
+    super(countingAdapter, self).__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    super(countingAdapter, self).init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+        'http': countingPool(HTTPConnectionPool, self.stats),
+        'https': countingPool(HTTPSConnectionPool, self.stats),
+    }
+
+  def send(self, *args, **kwargs):
+    self.stats.request()
+    return super(countingAdapter, self).send(*args, **kwargs)
+
+
+def makeSession(pool_size, hosts=4):
+  """Creates a keep-alive session with pool_size connections per host.
+
+  Requests block when all connections to a host are in use, rather than
+  opening short-lived extra connections. Counters are available through the
+  session's stats attribute.
+  """
+  session = requests.Session()
+  session.stats = connectionStats()
+  adapter = countingAdapter(
+      session.stats,
+      pool_connections=hosts,
+      pool_maxsize=pool_size,
+      pool_block=True)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
@@ -1,8 +1,10 @@
 import datetime
 import mistune
+import os
 import re
-import requests
 import string
+import threading
+import traceback
 
 from logger import getLogger
 """Converts discourse markdown into a telegram compatible version."""
@@ -52,93 +54,117 @@ def pluginQuote(md):
   md.block.rules.append('quote')
 
 
+# Characters telegram requires to be escaped in MarkdownV2 text, and inside
+# code blocks.
+TO_ESCAPE = '_*[]()~`>#+-=|{}.!'
+TO_ESCAPE_IN_CODE = '`\\'
+
+ESCAPE_TABLE = str.maketrans({c: '\\' + c for c in TO_ESCAPE})
+# Code blocks have few characters to escape, a regex skips over the rest faster
+# than a translation table.
+ESCAPE_IN_CODE_REGEX = re.compile('([{}])'.format(re.escape(TO_ESCAPE_IN_CODE)))
+
+# Outside of code blocks; an escaped punctuation, a markdown marker or a
+# backtick opening a code block.
+UNESCAPE_REGEX = re.compile(
+    r'\\(?P<escaped>[{0}])|(?P<marker>[{1}])|(?P<code>`)'.format(
+        re.escape(TO_ESCAPE), re.escape(TO_ESCAPE.replace('`', ''))))
+# Inside of code blocks; a backslash or a backtick closing the block.
+UNESCAPE_IN_CODE_REGEX = re.compile(r'(?P<marker>\\)|(?P<code>`)')
+
+
 def unescape(text):
   """Unescapes punctuation and drops markdown markers in text."""
-  toEscape = {
-      False: [
-          '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|',
-          '{', '}', '.', '!'
-      ],
-      True: ['`', '\\']
-  }
-
-  res = ''
-  i = 0
+  res = []
+  pos = 0
   insideCodeBlock = False
-  while i < len(text):
-    # strip markdown markers.
-    if text[i] in toEscape[insideCodeBlock]:
-      if text[i] == '`':
-        insideCodeBlock = not insideCodeBlock
-      i += 1
-      continue
+  while True:
+    regex = UNESCAPE_IN_CODE_REGEX if insideCodeBlock else UNESCAPE_REGEX
+    m = regex.search(text, pos)
+    if m is None:
+      res.append(text[pos:])
+      break
+    res.append(text[pos:m.start()])
+    # strip markdown markers, toggling code blocks on backticks.
+    if m.lastgroup == 'code':
+      insideCodeBlock = not insideCodeBlock
     # if this is a backslash and the next char is punctuation, print that one
     # instead.
-    if text[i] == '\\':
-      if i + 1 < len(text) and text[i + 1] in toEscape[insideCodeBlock]:
-        i += 1
-    res += text[i]
-    i += 1
-  return res
+    elif m.lastgroup == 'escaped':
+      res.append(m.group('escaped'))
+    pos = m.end()
+  return ''.join(res)
 
 
 def escape(text, inCodeBlock=False):
-  """Escapes characters specified in toEscape by prepending bachslashes.
+  """Escapes characters specified in TO_ESCAPE by prepending bachslashes.
 
-  By default toEscape is the list mentioned in telegram bot api.
+  TO_ESCAPE is the list mentioned in telegram bot api, TO_ESCAPE_IN_CODE is
+  used instead inside code blocks.
   """
-  if not inCodeBlock:
-    toEscape = [
-        '_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|',
-        '{', '}', '.', '!'
-    ]
-  else:
-    toEscape = ['`', '\\']
-
-  res = ''
-  for t in text:
-    if t in toEscape:
-      res += '\\'
-    res += t
-  return res
+  if inCodeBlock:
+    return ESCAPE_IN_CODE_REGEX.sub(r'\\\1', text)
+  return text.translate(ESCAPE_TABLE)
+
+
+# Bundled shortcode to unicode table, generated by tools/build_emoji_table.py.
+EMOJI_TABLE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'emoji_table.tsv')
+# Optional table in the same format, its entries take precedence over the
+# bundled ones. driver.py points it next to conf.ini with setEmojiOverride.
+EMOJI_OVERRIDE = 'emoji_override.tsv'
+emojiLock = threading.Lock()
+
+
+def loadEmojiTable(path, mapping):
+  """Adds entries of a `shortcode\tcodepoint[-codepoint...]` file to mapping."""
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      line = line.rstrip('\n')
+      if not line or line.startswith('#'):
+        continue
+      key, value = line.split('\t', 1)
+      mapping[key] = ''.join(
+          chr(int(codepoint, 16)) for codepoint in value.split('-'))
 
 
 def emojiShortCodeToUnicode(shortcode):
   """Converts an emoji short code (+1) to its unicode equivalent.
 
-  Uses github api to build a shortcode to unicode mapping.
+  Uses the bundled table, loaded on first use, and EMOJI_OVERRIDE if it exists.
   """
-  # Build and cache the mapping at first request, if something fails keep using
-  # shortcodes as a fallback.
-  if not hasattr(emojiShortCodeToUnicode, 'mapping'):
-    try:
-      mapping = requests.get('https://api.github.com/emojis').json()
-      for key, value in mapping.items():
-        # value can be in one of two forms:
-        # https://github.githubassets.com/images/icons/emoji/unicode/1f4a4.png?v8
-        # https://github.githubassets.com/images/icons/emoji/atom.png?v8
-        # We drop the non-unicode ones.
-        if '/unicode/' not in value:
-          mapping[key] = key
-          continue
-        # For unicode ones, sometimes there are multiple code points, e.g:
-        # https://github.githubassets.com/images/icons/emoji/unicode/1f1e6-1f1fa.png?v8
-        value = value.split('/')[-1].split('.png')[0].split('-')
-        value = ''.join(map(lambda codepoint: chr(int(codepoint, 16)), value))
-        mapping[key] = value
-      emojiShortCodeToUnicode.mapping = mapping
-    except Exception as e:
-      logger.error('{} {}', e, datetime.datetime.now())
-      traceback.print_exc()
-      emojiShortCodeToUnicode.mapping = {}
-
-  unic = emojiShortCodeToUnicode.mapping.get(unescape(shortcode), None)
+  mapping = getattr(emojiShortCodeToUnicode, 'mapping', None)
+  if mapping is None:
+    with emojiLock:
+      mapping = getattr(emojiShortCodeToUnicode, 'mapping', None)
+      if mapping is None:
+        mapping = {}
+        # If something fails keep using shortcodes as a fallback.
+        for path in (EMOJI_TABLE, EMOJI_OVERRIDE):
+          if path != EMOJI_TABLE and not os.path.exists(path):
+            continue
+          try:
+            loadEmojiTable(path, mapping)
+          except Exception as e:
+            logger.error('{} {}', e, datetime.datetime.now())
+            traceback.print_exc()
+        emojiShortCodeToUnicode.mapping = mapping
+
+  unic = mapping.get(unescape(shortcode), None)
   if not unic:
     unic = f':{shortcode}:'
     logger.debug('unknown shortcode: {0}', shortcode)
   return unic
 
 
+def setEmojiOverride(path):
+  """Uses path as EMOJI_OVERRIDE, tables are reloaded on next use."""
+  global EMOJI_OVERRIDE
+  with emojiLock:
+    EMOJI_OVERRIDE = path
+    emojiShortCodeToUnicode.mapping = None
+
+
 class telegramAttachment:
 
   def __init__(self, url):
@@ -153,10 +179,17 @@ class telegramRenderer(mistune.renderers.BaseRenderer):
 
   def __init__(self):
     super(telegramRenderer, self).__init__()
-    self.attachments = []
+    # A single renderer is shared by all threads, per document state is kept
+    # thread local.
+    self.local = threading.local()
+
+  def reset(self):
+    self.local.attachments = []
 
   def takeAttachments(self):
-    return self.attachments
+    attachments = self.local.attachments
+    self.local.attachments = []
+    return attachments
 
   def createDefaultHandler(self, name):
     logger.error('Creating default method for unhandled rule: {}', name)
@@ -237,13 +270,15 @@ class telegramRenderer(mistune.renderers.BaseRenderer):
     if link.startswith(self.UPLOAD_SCHEME):
       link = 'https://cow.ceng.metu.edu.tr/uploads/short-url/' + link[
           len(self.UPLOAD_SCHEME):]
-      self.attachments.append(telegramAttachment(link))
+      self.local.attachments.append(telegramAttachment(link))
     if text is None:
-      if title is None:
-        text = link
-      else:
-        text = title
-    text = escape(text)
+      text = link if title is None else title
+    if isinstance(text, str):
+      # Autolinks pass their raw text.
+      text = escape(text)
+    else:
+      # Link text comes as a list of already rendered children.
+      text = ''.join(text)
     return f'[{text}]({link})'
 
   def image(self, src, alt='', title=None):
@@ -255,7 +290,7 @@ class telegramRenderer(mistune.renderers.BaseRenderer):
     if src.startswith(self.UPLOAD_SCHEME):
       src = 'https://cow.ceng.metu.edu.tr/uploads/short-url/' + src[
           len(self.UPLOAD_SCHEME):]
-      self.attachments.append(telegramAttachment(src))
+      self.local.attachments.append(telegramAttachment(src))
     return f'[{escape(title)}]({src})'
 
   def quote(self, children, user, post_id, topic_id, *args):
@@ -292,9 +327,14 @@ class telegramRenderer(mistune.renderers.BaseRenderer):
     return escape(text)
 
 
+# Parser, plugin rules and renderer are built once and shared by all calls.
+renderer = telegramRenderer()
+markdown = mistune.create_markdown(
+    renderer=renderer, plugins=[pluginEmoji, pluginQuote])
+
+
 def convertDiscourseToTelegram(content):
-  logger.debug(f'Got discourse markdown: {content}')
-  renderer = telegramRenderer()
-  paragraphs = mistune.markdown(
-      content, renderer=renderer, plugins=[pluginEmoji, pluginQuote])
+  logger.debug('Got discourse markdown: {}', content)
+  renderer.reset()
+  paragraphs = markdown(content)
   return paragraphs, renderer.takeAttachments()
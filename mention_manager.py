@@ -9,19 +9,15 @@ class mentionManager:
     search = self.student_no_matcher.search(msg)
     return search if search is None else search.group()
 
-  def __init__(self, db, cow_bot):
+  def __init__(self, db):
     self.student_no_matcher = re.compile("e?\d{6,7}")
     self.db = db
-    self.cow_bot = cow_bot
     self.mention_text = "Your alias *{}* has been mentioned in " + \
             "newsgroup: *{}* with header: *{}* at line: {}\."
 
-  def sendMention(self, cid, alias, newsgroup, header, line_no):
-    return self.cow_bot.sendMsg(
-        cid,
-        self.mention_text.format(
-            escape(alias), escape(newsgroup), escape(header), line_no),
-        escaped=True)
+  def makeMention(self, alias, newsgroup, header, line_no):
+    return self.mention_text.format(
+        escape(alias), escape(newsgroup), escape(header), line_no)
 
   def getMinimalStudentNo(self, student_no):
     base = student_no
@@ -31,23 +27,39 @@ class mentionManager:
     return base
 
   def parseMentions(self, content, newsgroup):
+    """Returns [(escaped text, cids)] notifications for the aliases in content.
+
+    They are delivered through the outbox together with the post.
+    """
     current_header = ""
     line_no = 0
+    mentions = []
     for raw_line in content.split("\n"):
       line = raw_line.strip()
       if line.startswith("> "):
         continue
       student_no = self.isStudentNumber(line)
       if student_no is not None:
-        cids = self.db.checkForAlias(self.getMinimalStudentNo(student_no))
-        if cids is None:
-          continue
         header = current_header
         if len(line) > len(student_no):
           header = line
-        for cid in cids:
-          self.sendMention(cid, student_no, newsgroup, header, line_no)
+        mentions.append((student_no, header, line_no))
       else:
         current_header = line
         line_no = 0
       line_no += 1
+    if not mentions:
+      return []
+
+    # Look up all aliases of the post at once.
+    aliases = self.db.checkForAliases(
+        [self.getMinimalStudentNo(mention[0]) for mention in mentions])
+    if aliases is None:
+      return []
+    res = []
+    for student_no, header, line_no in mentions:
+      cids = list(aliases.get(self.getMinimalStudentNo(student_no), []))
+      if cids:
+        res.append((self.makeMention(student_no, newsgroup, header,
+                                     line_no), cids))
+    return res
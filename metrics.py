@@ -0,0 +1,194 @@
+"""Minimal in-process metrics, exported in the prometheus text format."""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets in seconds, from a fast API call to a flood control wait.
+LATENCY_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escapeLabel(value):
+  value = str(value).replace('\\', '\\\\')
+  return value.replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatLabels(names, values, extra=()):
+  pairs = list(zip(names, values)) + list(extra)
+  if not pairs:
+    return ''
+  return '{' + ','.join(
+      f'{name}="{escapeLabel(value)}"' for name, value in pairs) + '}'
+
+
+class metric:
+  KIND = 'untyped'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def header(self):
+    return [
+        f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.KIND}'
+    ]
+
+  def samples(self):
+    with self.lock:
+      values = list(self.values.items())
+    return [
+        f'{self.name}{formatLabels(self.labels, key)} {value}'
+        for key, value in values
+    ]
+
+  def render(self):
+    return self.header() + self.samples()
+
+
+class counter(metric):
+  KIND = 'counter'
+
+  def inc(self, *labels, amount=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class gauge(metric):
+  """A value that is either set directly or read from fn at render time.
+
+  fn returns a number, or a {label values: number} dict for labelled gauges.
+  """
+  KIND = 'gauge'
+
+  def __init__(self, name, help, labels=(), fn=None, kind=None):
+    super(gauge, self).__init__(name, help, labels)
+    self.fn = fn
+    if kind is not None:
+      self.KIND = kind
+
+  def set(self, value, *labels):
+    with self.lock:
+      self.values[labels] = value
+
+  def samples(self):
+    if self.fn is not None:
+      values = self.fn()
+      if not isinstance(values, dict):
+        values = {(): values}
+      with self.lock:
+        self.values = values
+    return super(gauge, self).samples()
+
+
+class histogram(metric):
+  KIND = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    super(histogram, self).__init__(name, help, labels)
+    self.buckets = tuple(buckets)
+
+  def observe(self, value, *labels):
+    idx = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      entry = self.values.get(labels)
+      if entry is None:
+        entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0., 0]
+      entry[0][idx] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  def samples(self):
+    with self.lock:
+      values = [(key, (list(counts), total, count))
+                for key, (counts, total, count) in self.values.items()]
+    res = []
+    for key, (counts, total, count) in values:
+      cumulative = 0
+      for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+        cumulative += bucket
+        res.append(f'{self.name}_bucket'
+                   f'{formatLabels(self.labels, key, [("le", bound)])} '
+                   f'{cumulative}')
+      res.append(f'{self.name}_sum{formatLabels(self.labels, key)} {total}')
+      res.append(f'{self.name}_count{formatLabels(self.labels, key)} {count}')
+    return res
+
+
+class registry:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.metrics = {}
+
+  def register(self, m):
+    # Re-registering replaces the old metric, e.g. when a new bot is created.
+    with self.lock:
+      self.metrics[m.name] = m
+    return m
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+    lines = []
+    for m in metrics:
+      lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = registry()
+
+
+def makeCounter(name, help, labels=()):
+  return REGISTRY.register(counter(name, help, labels))
+
+
+def makeGauge(name, help, labels=(), fn=None, kind=None):
+  return REGISTRY.register(gauge(name, help, labels, fn, kind))
+
+
+def makeHistogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+  return REGISTRY.register(histogram(name, help, labels, buckets))
+
+
+class metricsServer(threading.Thread):
+  """Serves REGISTRY over plain HTTP on its own listener.
+
+  Metrics aren't authenticated, so the default is to only listen on localhost
+  instead of the public webhook port.
+  """
+
+  class ReqHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path != self.server.path:
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      payload = REGISTRY.render().encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', CONTENT_TYPE)
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def log_message(self, *args):
+      # Scrapes would fill the logs otherwise.
+      pass
+
+  # http.server.ThreadingHTTPServer needs python 3.7.
+  class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+  def __init__(self, host='127.0.0.1', port=9100, path='/metrics'):
+    threading.Thread.__init__(self, daemon=True)
+    self.httpd = self.ThreadedHTTPServer((host, port), self.ReqHandler)
+    self.httpd.path = path
+
+  def run(self):
+    self.httpd.serve_forever()
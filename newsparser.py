@@ -1,7 +1,9 @@
 import datetime
+import threading
 import traceback
 from logger import getLogger
 from markdownrenderer import convertDiscourseToTelegram, escape
+from telegrammessage import telegramMessage
 
 logger = getLogger(__name__)
 
@@ -44,6 +46,11 @@ class newsArticle:
     self.tg_markdown = None
     self.is_plus_one = None
     self.attachments = None
+    self.message = None
+    # [(telegramMessage, cids)] notifications of mentioned aliases.
+    self.mentions = None
+    # Articles are sent to many chats concurrently, render only once.
+    self.lock = threading.Lock()
 
   def isPlusOne(self):
     if self.is_plus_one is None:
@@ -51,16 +58,26 @@ class newsArticle:
     return self.is_plus_one
 
   def parse(self):
-    # TODO(kadircet): Improve handling of 4K text limit.
     if self.tg_markdown is None:
       self.parseMessage()
     return self.tg_markdown
 
+  def getMessage(self):
+    """Returns the article as a telegramMessage shared by all recipients."""
+    if self.message is None:
+      self.parseMessage()
+    return self.message
+
   def getAttachments(self):
     if self.attachments is None:
       self.parseMessage()
     return self.attachments
 
+  def getMentions(self):
+    if self.mentions is None:
+      self.parseMessage()
+    return self.mentions or []
+
   def makeHeader(self):
     hdr = f"From: {self.author_username}({self.author_displayname})\n"\
         f"Newsgroup: {self.topic}\n"\
@@ -71,14 +88,24 @@ class newsArticle:
     return link_to_post + '```\n' + escape(hdr, True) + '\n```\n'
 
   def parseMessage(self):
-    if self.broken:
+    with self.lock:
+      self._parseMessage()
+
+  def _parseMessage(self):
+    if self.broken or self.tg_markdown is not None:
       return
 
     try:
-      self.mention_manager.parseMentions(self.dc_markdown, self.topic)
+      mentions = self.mention_manager.parseMentions(self.dc_markdown,
+                                                    self.topic)
       paragraphs, attachments = convertDiscourseToTelegram(self.dc_markdown)
-      self.tg_markdown = self.makeHeader() + '\n\n'.join(paragraphs)
+      tg_markdown = self.makeHeader() + '\n\n'.join(paragraphs)
+      self.message = telegramMessage(tg_markdown, escaped=True)
       self.attachments = attachments
+      self.mentions = [
+          (telegramMessage(text, escaped=True), cids) for text, cids in mentions
+      ]
+      self.tg_markdown = tg_markdown
     except Exception as e:
       logger.error('{} {}', e, datetime.datetime.now())
       traceback.print_exc()
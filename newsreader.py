@@ -1,25 +1,105 @@
+import concurrent.futures
 import traceback
 import threading
 import time
 import datetime
 import html
 import json
+import re
 import requests
 import sys
 from newsparser import newsArticle
+from topiccache import topicCache
+from categoryindex import categoryIndex
+from topicsearch import topicSearch
+from httpsession import makeSession
+from metrics import makeCounter, makeHistogram
 from logger import getLogger
 
 logger = getLogger(__name__)
 
+FORUM_LATENCY = makeHistogram('cow_forum_request_duration_seconds',
+                              'Latency of forum API requests.', ('endpoint',))
+FORUM_ERRORS = makeCounter('cow_forum_request_errors_total',
+                           'Failed forum API requests.', ('code',))
+# Replaces ids in endpoints, to keep the number of label values bounded.
+ENDPOINT_ID_REGEX = re.compile(r'\d+')
+# Pages of the latest posts list read beyond the ones needed to reach the
+# watermark, for posts created while paging.
+LISTING_SLACK_PAGES = 2
+
+
+class pollScheduler:
+  """Picks the delay before the next forum poll.
+
+  Polls are repeated every min_interval seconds while new posts are arriving,
+  the delay doubles after every idle poll up to max_interval.
+  """
+
+  def __init__(self, min_interval=5, max_interval=120, factor=2):
+    self.min_interval = min_interval
+    self.max_interval = max(min_interval, max_interval)
+    self.factor = factor
+    self.interval = min_interval
+
+  def next(self, new_posts):
+    """Returns the delay after a poll that found new_posts posts."""
+    if new_posts > 0:
+      self.interval = self.min_interval
+    else:
+      self.interval = min(self.max_interval, self.interval * self.factor)
+    return self.interval
+
 
 class newsReader:
 
-  def __init__(self, host, port, uname, pw, lfile, auth, timezone):
-    self.conparams = [host, port, uname, pw, auth]
-    self.lfile = lfile
-    self.timezone = timezone
+  def __init__(self, options):
+    # options is the news section of the conf.
+    self.conparams = [
+        options['host'], options['port'], options['user'], options['pass'],
+        options['auth']
+    ]
+    self.lfile = options['last']
+    self.timezone = options['timezone']
+    self.options = options
+    self.topics = topicCache(
+        self.options.get('topic_cache', 'topic_cache.json'),
+        self.options.get('topic_cache_size', 10000),
+        self.options.get('topic_cache_ttl', 6 * 60 * 60))
+    # Number of posts fetched concurrently, 1 fetches them serially for forums
+    # with strict rate limits.
+    self.fetch_concurrency = max(1, self.options.get('fetch_concurrency', 8))
+    if self.options.get('serial_fetch', False):
+      self.fetch_concurrency = 1
+    # 'listing' builds articles from the latest posts list and only fetches
+    # posts missing from it, 'posts' fetches every post individually.
+    self.fetch_mode = self.options.get('fetch_mode', 'listing')
+    # Keep-alive connections to the forum, one per concurrent fetch.
+    self.session = makeSession(self.fetch_concurrency + 2)
+    self.executor = None
+    if self.fetch_concurrency > 1:
+      self.executor = concurrent.futures.ThreadPoolExecutor(
+          self.fetch_concurrency, thread_name_prefix='fetcher')
+    # Watermark to move to once the posts of the last poll are stored.
+    self.next_post = None
+    # ETag of the latest posts list, only kept once every post in it was
+    # stored. Until then the list is downloaded again.
+    self.etag = None
+    self.next_etag = None
+    self.category_index = categoryIndex()
+    self.topic_search = topicSearch()
+    self.category_etag = None
+    self.category_lock = threading.Lock()
+    self.category_refresh = self.options.get('category_refresh_interval', 3600)
     self.initialized = False
     self.initConnection()
+    threading.Thread(
+        target=self.refreshCategories, name='categories', daemon=True).start()
+
+  @property
+  def categories(self):
+    """{category id: name}, taken from the current category index."""
+    return self.category_index.names
 
   # TODO: Make this function higher level
   def makeAPICall(self, endpoint, params={}, **kwargs):
@@ -27,35 +107,44 @@ class newsReader:
     timeout = kwargs.get('timeout', 30)
     retry = kwargs.get('retry', False)
     redirect = kwargs.get('redirect', True)
+    headers = kwargs.get('headers', None)
     backoff = 1
     if not endpoint.endswith('/'):
       endpoint += '/'
     req_url = self.conparams[0] + endpoint
+    label = ENDPOINT_ID_REGEX.sub('{id}', endpoint)
     while True:
+      start = time.monotonic()
       try:
         # do POST request
         if post:
-          resp = requests.post(
+          resp = self.session.post(
               req_url,
               data=params,
+              headers=headers,
               cookies=self.token,
               timeout=timeout,
               allow_redirects=redirect)
         else:  # do GET request
-          resp = requests.get(
+          resp = self.session.get(
               req_url,
               params=params,
+              headers=headers,
               cookies=self.token,
               timeout=timeout,
               allow_redirects=redirect)
+        FORUM_LATENCY.observe(time.monotonic() - start, label)
         resp.raise_for_status()
         return resp, resp.status_code
       except requests.exceptions.RequestException as e:
+        code = None if e.response is None else e.response.status_code
+        # Errors without a response, e.g. timeouts, are counted as 'network'.
+        FORUM_ERRORS.inc('network' if code is None else code)
         logger.error('Request Failed: {} -- Endpoint: {}, Data: {}', e,
                      endpoint, params)
         resp = None
         if not retry:
-          return resp, e.response.status_code
+          return resp, code
         logger.error('Retrying in {} seconds', backoff)
         time.sleep(backoff)
         backoff = max(60, backoff * 2)
@@ -65,26 +154,35 @@ class newsReader:
         traceback.print_exc()
         sys.exit(1)
 
-  def populateCategories(self):
-    # Grab category ids and names
-    categories = {}
-    resp, _ = self.makeAPICall('site.json', retry=True)
-    resp_categories = resp.json()['categories']
-    parent = {}
-    for item in resp_categories:
-      categories[item['id']] = item['name']
-      parent[item['id']] = item.get('parent_category_id', None)
-
-    self.categories = {}
-    for id, name in categories.items():
-      parents = [name]
-      cur_id = id
-      while parent[id] is not None:
-        parents.append(categories[parent[id]])
-        id = parent[id]
-      cat_name = '.'.join(parents[::-1])
-      logger.debug('Got category: {} - {}', cur_id, cat_name)
-      self.categories[cur_id] = cat_name
+  def populateCategories(self, retry=True):
+    """Swaps in a new category index if the categories changed.
+
+    Returns whether the index was replaced.
+    """
+    with self.category_lock:
+      headers = {}
+      if self.category_etag is not None:
+        headers['If-None-Match'] = self.category_etag
+      resp, code = self.makeAPICall('site.json', retry=retry, headers=headers)
+      if resp == None or code == 304:
+        return False
+      index = categoryIndex(resp.json()['categories'])
+      for cat_id, name in index.names.items():
+        if cat_id not in self.category_index:
+          logger.debug('Got category: {} - {}', cat_id, name)
+      self.topic_search.update(self.category_index.names, index.names)
+      self.category_index = index
+      self.category_etag = resp.headers.get('ETag')
+      return True
+
+  def refreshCategories(self):
+    while True:
+      time.sleep(self.category_refresh)
+      try:
+        self.populateCategories(retry=False)
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
 
   def initConnection(self):
     self.updateAuthToken()
@@ -124,26 +222,133 @@ class newsReader:
         break
 
   def getIdForTopic(self, topic):
-    for cat_id, name in self.categories.items():
-      if name == topic:
-        return cat_id
-    return -1
+    return self.category_index.getId(topic)
 
   def validTopic(self, topic):
-    return topic in self.categories.values()
+    return self.category_index.getId(topic) != -1
 
   def closest(self, topic, topics=None):
-    if topics == None:
-      topics = self.categories.values()
-    pos = []
-    topic = topic.lower()
-    for t in topics:
-      t_lower = t.lower()
-      if t_lower == topic.lower():
-        return [t]
-      if topic in t_lower:
-        pos.append(t)
-    return pos
+    """Returns the category names matching topic best.
+
+    topics optionally restricts the matches, e.g. to a user's subscriptions.
+    """
+    return self.topic_search.search(topic, topics)
+
+  def getTopic(self, topic_id):
+    """Returns ({'category_id', 'title'}, code) for topic_id.
+
+    Topic info is served from the topic cache when possible, a None topic
+    means the lookup failed with the HTTP status code.
+    """
+    cached = self.topics.get(topic_id)
+    if cached is not None:
+      return {'category_id': cached[0], 'title': cached[1]}, 200
+    topic, code = self.makeAPICall(f't/{topic_id}.json')
+    if topic == None:
+      return None, code
+    topic = topic.json()
+    self.topics.put(topic_id, topic['category_id'], topic['title'])
+    return topic, code
+
+  def observeTopics(self, posts):
+    # Entries of the latest posts list carry their topic's current category
+    # and title, use them to find topics that were moved or renamed.
+    for p in posts:
+      if 'category_id' in p and 'topic_title' in p:
+        self.topics.observe(p['topic_id'], p['category_id'], p['topic_title'])
+
+  def fetchPost(self, post_id):
+    """Fetches a post and its topic.
+
+    Returns (post, topic, code), post is None if any of the requests failed
+    with the HTTP status code.
+    """
+    post, code = self.makeAPICall(f'posts/{post_id}.json')
+    if post == None:
+      return None, None, code
+    post = post.json()
+    # post information we get through 'posts/{id}.json'
+    # doesn't contain category_id and topic_title so
+    # we need to look up the topic for that info.
+    topic, code = self.getTopic(post['topic_id'])
+    if topic == None:
+      return None, None, code
+    return post, topic, code
+
+  def fetchPosts(self, post_ids):
+    """Yields (post_id, post, topic, code) for post_ids, in order.
+
+    Posts are fetched fetch_concurrency at a time, a window is only scheduled
+    once the consumer reaches it so stopping early wastes at most one window.
+    """
+    if self.executor is None:
+      for post_id in post_ids:
+        yield (post_id,) + self.fetchPost(post_id)
+      return
+    window = self.fetch_concurrency * 2
+    for i in range(0, len(post_ids), window):
+      ids = post_ids[i:i + window]
+      for post_id, result in zip(ids, self.executor.map(self.fetchPost, ids)):
+        yield (post_id,) + result
+
+  def fetchListing(self, posts, start):
+    """Pages the latest posts list backwards until the post after start.
+
+    posts is the first page. Returns {post_id: (post, topic)} for the posts
+    after start that carry everything needed to build an article. Only
+    enough pages to cover the ids after start are read, plus
+    LISTING_SLACK_PAGES. Posts that weren't reached are fetched one by one by
+    collectPosts.
+    """
+    entries = {}
+    if not posts:
+      return entries
+    pages = (max([p['id'] for p in posts]) - start) // len(posts)
+    pages += LISTING_SLACK_PAGES
+    while posts:
+      for p in posts:
+        if p['id'] <= start or p.get('raw') is None or p.get(
+            'category_id') is None or p.get('topic_title') is None:
+          continue
+        topic = {'category_id': p['category_id'], 'title': p['topic_title']}
+        self.topics.put(p['topic_id'], topic['category_id'], topic['title'])
+        entries[p['id']] = (p, topic)
+      before = min([p['id'] for p in posts])
+      pages -= 1
+      if before <= start + 1:
+        break
+      if pages <= 0:
+        logger.error('Stopped paging posts.json at before={}', before)
+        break
+      resp, _ = self.makeAPICall('posts.json', params={'before': before})
+      if resp == None:
+        break
+      posts = resp.json()['latest_posts']
+      if posts and min([p['id'] for p in posts]) >= before:
+        logger.error('posts.json ignored before={}', before)
+        break
+      self.observeTopics(posts)
+    return entries
+
+  def collectPosts(self, post_ids, listed):
+    """Same as fetchPosts but takes posts found in listed when possible."""
+    fetched = self.fetchPosts([i for i in post_ids if i not in listed])
+    for post_id in post_ids:
+      if post_id in listed:
+        yield (post_id,) + listed[post_id] + (200,)
+      else:
+        yield next(fetched)
+
+  def makeArticle(self, post, topic, mention_manager):
+    # TODO(kadircet): Also include link to the post via topic_id and post_count.
+    return newsArticle(
+        (post['username'], post['name']),
+        self.categories[topic['category_id']],
+        topic['title'],
+        (post['created_at'], self.timezone),
+        f'{self.conparams[0]}p/{post["id"]}',
+        post['raw'],  # raw msg (markdown)
+        mention_manager)
 
   def updatePosts(self, mention_manager):
     if not self.initialized:
@@ -152,54 +357,57 @@ class newsReader:
     if time.time() - self.time > 60. * 60 * 24:
       self.updateAuthToken()
 
-    # Get latest posts
-    resp, _ = self.makeAPICall('posts.json', params={'before': 0})
-    if resp == None:
+    # Get latest posts, an unchanged list costs a 304 without a body.
+    headers = {}
+    if self.etag is not None:
+      headers['If-None-Match'] = self.etag
+    resp, code = self.makeAPICall(
+        'posts.json', params={'before': 0}, headers=headers)
+    if resp == None or code == 304:
       return {}
     posts = json.loads(resp.text)['latest_posts']
+    self.observeTopics(posts)
     last = max([p['id'] for p in posts])
     start = self.last_post
     res = {}
-    while start < last:
-      start += 1
-      # Get post
-      post, code = self.makeAPICall(f'posts/{start}.json')
+    listed = {}
+    refreshed = False
+    if self.fetch_mode == 'listing':
+      listed = self.fetchListing(posts, start)
+    # start only moves over contiguous ids that were either processed or are
+    # inaccessible, so a failed post is retried on the next poll.
+    for post_id, post, topic, code in self.collectPosts(
+        range(start + 1, last + 1), listed):
       if post == None:
         if code == 403 or code == 404:
+          start = post_id
           continue
-        start -= 1
-        break
-      post = post.json()
-      # post information we get through 'posts/{id}.json'
-      # doesn't contain category_id and topic_title so
-      # we need to make another request for that info.
-      # TODO: Cache topic_id -> category_id and
-      #       topic_id -> topic_title mappings
-
-      # Get post's topic for category and title
-      topic, code = self.makeAPICall(f"t/{post['topic_id']}.json")
-      if topic == None:
-        if code == 403 or code == 404:
-          continue
-        start -= 1
         break
-      topic = topic.json()
-      if topic['category_id'] not in self.categories:
+      if topic['category_id'] not in self.category_index and not refreshed:
+        # Probably a category created after the last refresh.
+        refreshed = True
+        self.populateCategories(retry=False)
+      start = post_id
+      if topic['category_id'] not in self.category_index:
         logger.error('Unknown category_id: {}', topic['category_id'])
         continue
       if topic['category_id'] not in res:
         res[topic['category_id']] = []
-      # TODO(kadircet): Also include link to the post via topic_id and post_count.
       res[topic['category_id']].append(
-          newsArticle(
-              (post['username'], post['name']),
-              self.categories[topic['category_id']],
-              topic['title'],
-              (post['created_at'], self.timezone),
-              f'{self.conparams[0]}p/{post["id"]}',
-              post['raw'],  # raw msg (markdown)
-              mention_manager))
-    self.last_post = start
+          self.makeArticle(post, topic, mention_manager))
+    self.next_post = start
+    self.next_etag = resp.headers.get('ETag') if start >= last else None
+    return res
+
+  def commitPosts(self):
+    """Advances the watermark past the posts returned by updatePosts.
+
+    Called once those are stored, so they are fetched again if that fails.
+    """
+    if self.next_post is None:
+      return
+    self.last_post, self.next_post = self.next_post, None
+    self.etag, self.next_etag = self.next_etag, None
     with open(self.lfile, 'w') as f:
       f.write(str(self.last_post))
-    return res
+    self.topics.save()
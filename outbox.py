@@ -0,0 +1,215 @@
+import collections
+import datetime
+import functools
+import json
+import threading
+import time
+import traceback
+from markdownrenderer import telegramAttachment
+from telegrammessage import telegramMessage
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class storedArticle:
+  """An article restored from the outbox, holding only what delivery needs."""
+
+  def __init__(self, message, attachments):
+    self.message = message
+    self.attachments = attachments
+
+  def getMessage(self):
+    return self.message
+
+  def getAttachments(self):
+    return self.attachments
+
+  @staticmethod
+  def serialize(article):
+    return json.dumps({
+        'message': article.getMessage().toDict(),
+        'attachments': [a.url for a in article.getAttachments()]
+    })
+
+  @staticmethod
+  def deserialize(payload):
+    data = json.loads(payload)
+    return storedArticle(
+        telegramMessage.fromDict(data['message']),
+        [telegramAttachment(url) for url in data['attachments']])
+
+
+class outbox(threading.Thread):
+  """Durable queue of deliveries between the forum poller and the dispatcher.
+
+  The poller stores rendered articles together with their recipients in a
+  single transaction, only then is the forum watermark advanced. This thread
+  drains the stored deliveries into the dispatcher in id order and deletes
+  them in batches once they are sent, so a crash resends at most the
+  deliveries that were in flight. Deliveries that failed for a reason worth
+  retrying stay in the outbox, they are sent again when the drainer goes over
+  the outbox once more, retry_delay seconds after a failure. The poller blocks
+  while high_water deliveries are pending, and the drainer blocks while the
+  dispatcher is full.
+  """
+
+  def __init__(self,
+               bot,
+               batch_size=500,
+               high_water=20000,
+               cache_size=256,
+               retry_delay=30):
+    threading.Thread.__init__(self, daemon=True)
+    self.db = bot.db
+    self.dispatcher = bot.dispatcher
+    self.batch_size = batch_size
+    self.high_water = high_water
+    self.cache_size = cache_size
+    self.retry_delay = retry_delay
+    self.cond = threading.Condition()
+    self.pending = self.db.countDeliveries() or 0
+    # Outbox ids that were sent but not deleted yet.
+    self.delivered = set()
+    # Outbox ids handed to the dispatcher and not handled yet.
+    self.inflight = set()
+    # When to go over the outbox again for failed deliveries, None if none
+    # failed.
+    self.retry_at = None
+    # Id of the last outbox row handed to the dispatcher.
+    self.last_id = 0
+    # article id -> article. Keeps the instances shared by all recipients, and
+    # the plaintext fallbacks they picked up, across batches.
+    self.articles = collections.OrderedDict()
+
+  def qsize(self):
+    return self.pending
+
+  def cache(self, aid, article):
+    self.articles[aid] = article
+    self.articles.move_to_end(aid)
+    while len(self.articles) > self.cache_size:
+      self.articles.popitem(last=False)
+
+  def put(self, deliveries):
+    """Stores [(article, cids)] deliveries, returns whether they were stored.
+
+    Blocks while the outbox is above its high-water mark.
+    """
+    with self.cond:
+      while self.pending >= self.high_water:
+        self.cond.wait()
+    articles = []
+    for article, cids in deliveries:
+      if article.getMessage() is None:
+        continue
+      if cids:
+        articles.append((article, cids))
+      # Mentions are stored in the same transaction, so they are neither lost
+      # nor sent twice when the post is fetched again.
+      for message, mention_cids in article.getMentions():
+        articles.append((storedArticle(message, []), mention_cids))
+    if not articles:
+      return True
+    ids = self.db.addDeliveries([
+        (storedArticle.serialize(article), cids) for article, cids in articles
+    ])
+    if ids is None:
+      return False
+    with self.cond:
+      for aid, (article, cids) in zip(ids, articles):
+        self.cache(aid, article)
+        self.pending += len(cids)
+      self.cond.notify_all()
+    return True
+
+  def done(self, row_id, settled=True):
+    """Called by the dispatcher, the row is kept unless it is settled."""
+    with self.cond:
+      self.inflight.discard(row_id)
+      if not settled:
+        if self.retry_at is None:
+          self.retry_at = time.monotonic() + self.retry_delay
+        return
+      self.delivered.add(row_id)
+      if len(self.delivered) >= self.batch_size:
+        self.cond.notify_all()
+
+  def flush(self):
+    with self.cond:
+      delivered, self.delivered = self.delivered, set()
+    if not delivered:
+      return
+    # Articles without deliveries left are deleted along with the rows.
+    failed = self.db.deleteDeliveries(list(delivered)) != 0
+    with self.cond:
+      if failed:
+        self.delivered |= delivered
+        return
+      self.pending -= len(delivered)
+      self.cond.notify_all()
+
+  def resolve(self, rows):
+    """Returns {article id: article} for rows, None on failure."""
+    with self.cond:
+      res = {
+          aid: self.articles[aid] for _, _, aid in rows if aid in self.articles
+      }
+    missing = {aid for _, _, aid in rows if aid not in res}
+    payloads = self.db.getArticles(missing)
+    if payloads is None:
+      return None
+    with self.cond:
+      for aid, payload in payloads.items():
+        res[aid] = storedArticle.deserialize(payload)
+        self.cache(aid, res[aid])
+    return res
+
+  def drain(self):
+    """Hands the next batch to the dispatcher, returns the number of rows."""
+    rows = self.db.getDeliveries(self.last_id, self.batch_size)
+    if rows is None:
+      return None
+    articles = self.resolve(rows) if rows else {}
+    if articles is None:
+      return None
+    for row_id, cid, aid in rows:
+      self.last_id = row_id
+      with self.cond:
+        # Still being sent, or sent and not deleted yet.
+        if row_id in self.inflight or row_id in self.delivered:
+          continue
+        self.inflight.add(row_id)
+      # Blocks while the dispatcher is full.
+      self.dispatcher.submit(cid, articles[aid],
+                             functools.partial(self.done, row_id))
+    return len(rows)
+
+  def rewind(self):
+    """Starts over from the first row once failed deliveries are due."""
+    with self.cond:
+      if self.retry_at is None or time.monotonic() < self.retry_at:
+        return False
+      self.retry_at = None
+      self.last_id = 0
+      return True
+
+  def run(self):
+    backoff = 1
+    while True:
+      try:
+        self.flush()
+        count = self.drain()
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
+        count = None
+      if count is None:
+        logger.error('Retrying outbox in {} seconds', backoff)
+        time.sleep(backoff)
+        backoff = min(60, backoff * 2)
+        continue
+      backoff = 1
+      if count == 0 and not self.rewind():
+        with self.cond:
+          self.cond.wait(5)
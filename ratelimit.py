@@ -0,0 +1,92 @@
+import threading
+import time
+
+
+class tokenBucket:
+  """Thread-safe token bucket.
+
+  Tokens are reserved rather than polled, the balance is allowed to go
+  negative and reserve returns how long the caller has to wait for its token.
+  This keeps callers in FIFO order without any busy waiting.
+  """
+
+  def __init__(self, rate, capacity):
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self.tokens = self.capacity
+    self.stamp = time.monotonic()
+    self.lock = threading.Lock()
+
+  def refill(self, now):
+    self.tokens = min(self.capacity,
+                      self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+
+  def reserve(self):
+    with self.lock:
+      self.refill(time.monotonic())
+      self.tokens -= 1
+      if self.tokens >= 0:
+        return 0.
+      return -self.tokens / self.rate
+
+  def pause(self, secs):
+    """Makes sure no token is handed out in the next secs seconds."""
+    with self.lock:
+      self.refill(time.monotonic())
+      self.tokens = min(self.tokens, 0.) - secs * self.rate
+
+  def idle(self, now):
+    """Whether the bucket is full again, i.e. can be dropped safely."""
+    with self.lock:
+      self.refill(now)
+      return self.tokens >= self.capacity
+
+
+class rateLimiter:
+  """Proactive rate limiting for Telegram Bot API calls.
+
+  Telegram allows around 30 messages per second in total, 1 message per second
+  to a private chat and 20 messages per minute to a group. Every send first
+  acquires a token from the chat's bucket and then from the global one.
+  """
+  MAX_CHAT_BUCKETS = 4096
+
+  def __init__(self, global_rate=30, chat_rate=1, group_rate=20 / 60.):
+    self.global_bucket = tokenBucket(global_rate, global_rate)
+    self.chat_rate = chat_rate
+    self.group_rate = group_rate
+    self.chats = {}
+    self.lock = threading.Lock()
+
+  def chatBucket(self, cid):
+    with self.lock:
+      bucket = self.chats.get(cid)
+      if bucket is None:
+        if len(self.chats) >= self.MAX_CHAT_BUCKETS:
+          self.prune()
+        # Negative chat ids belong to groups and channels.
+        rate = self.group_rate if cid < 0 else self.chat_rate
+        bucket = self.chats[cid] = tokenBucket(rate, max(1, rate))
+      return bucket
+
+  def prune(self):
+    now = time.monotonic()
+    for cid in [cid for cid, b in self.chats.items() if b.idle(now)]:
+      del self.chats[cid]
+
+  def acquire(self, cid=None):
+    if cid is not None:
+      wait = self.chatBucket(cid).reserve()
+      if wait > 0:
+        time.sleep(wait)
+    wait = self.global_bucket.reserve()
+    if wait > 0:
+      time.sleep(wait)
+
+  def penalize(self, cid, secs):
+    """Applies a retry_after received from Telegram."""
+    if cid is None:
+      self.global_bucket.pause(secs)
+    else:
+      self.chatBucket(cid).pause(secs)
@@ -1,6 +1,7 @@
 from socketserver import ThreadingMixIn
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import datetime
+import queue
 import ssl
 import traceback
 import threading
@@ -11,20 +12,50 @@ from logger import getLogger
 logger = getLogger(__name__)
 
 
+def makeSSLContext(certfile):
+  """Loads the certificate once, to be shared by all connections."""
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(certfile)
+  return context
+
+
+def handleRequest(path, body, token, q):
+  """Handles a request to the webhook server.
+
+  Returns (status, content type, payload). Updates are put into q, if it is
+  full telegram is asked to retry later.
+  """
+  if path == '/' + token:
+    try:
+      data = json.loads(body.decode('utf-8'))
+      logger.info('Received {}', data)
+      q.put_nowait(data)
+    except queue.Full:
+      logger.error('Update queue is full, dropping {}', data)
+      return 503, None, b''
+    except Exception as e:
+      logger.error('{} {}', e, datetime.datetime.now())
+      traceback.print_exc()
+  return 200, None, b''
+
+
 class webHook(threading.Thread):
 
   class ReqHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
       try:
-        self.send_response(200)
-        self.end_headers()
+        body = b''
         if self.path == '/' + self.token:
-          data = self.rfile.read(int(
-              self.headers['Content-Length'])).decode('utf-8')
-          data = json.loads(data)
-          logger.info('Received {}', data)
-          self.q.put(data)
+          body = self.rfile.read(int(self.headers['Content-Length']))
+        status, content_type, payload = handleRequest(self.path, body,
+                                                      self.token, self.q)
+        self.send_response(status)
+        if content_type is not None:
+          self.send_header('Content-Type', content_type)
+          self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
       except Exception as e:
         logger.error('{} {}', e, datetime.datetime.now())
         traceback.print_exc()
@@ -36,11 +67,8 @@ class webHook(threading.Thread):
 
     def get_request(self):
       newsock, addr = self.socket.accept()
-      newsock = ssl.wrap_socket(
-          newsock,
-          certfile=self.certfile,
-          do_handshake_on_connect=False,
-          server_side=True)
+      newsock = self.context.wrap_socket(
+          newsock, do_handshake_on_connect=False, server_side=True)
       timeout = newsock.gettimeout()
       newsock.settimeout(2.)
       newsock.do_handshake()
@@ -51,8 +79,9 @@ class webHook(threading.Thread):
     threading.Thread.__init__(self)
     self.ReqHandler.token = conf['bot']['token']
     self.ReqHandler.q = q
-    httpd = self.ThreadedHTTPServer(('0.0.0.0', 8443), self.ReqHandler)
-    httpd.certfile = conf['web']['cert']
+    httpd = self.ThreadedHTTPServer(('0.0.0.0', conf['web'].get('port', 8443)),
+                                    self.ReqHandler)
+    httpd.context = makeSSLContext(conf['web']['cert'])
     self.httpd = httpd
 
   def run(self):
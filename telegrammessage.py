@@ -0,0 +1,276 @@
+import functools
+import re
+import threading
+import types
+from markdownrenderer import escape, unescape
+
+
+def isParseError(res):
+  """Whether telegram rejected a message because of its markdown."""
+  return res.get('error_code') == 400 and res.get(
+      'description', '').startswith('Bad Request: can\'t parse entities:')
+
+
+def isPermanentError(res):
+  """Whether resending can't help, e.g. the user blocked the bot.
+
+  Flood control that outlasted the retries, server errors and requests that
+  got no response at all are worth trying again later.
+  """
+  return res.get('error_code') in (400, 403)
+
+
+# Markers of MarkdownV2 formatting entities.
+ENTITY_MARKERS = ('__', '||', '*', '_', '~')
+# A code fence, line breaks, spaces, a marker or a run of plain text and
+# escaped characters.
+TOKEN_REGEX = re.compile(
+    r'```|\n\n+|\n| +|__|\|\||[*_~`\[\]()]'
+    r'|(?P<plain>(?:[^\\`\n *_~|\[\]()]|\\.)+)|.', re.S)
+# Same inside code, where lines are only split at line breaks or when they are
+# too long for a message.
+CODE_TOKEN_REGEX = re.compile(r'```|`|\n\n+|\n|(?P<plain>(?:[^\\`\n]|\\.)+)|.',
+                              re.S)
+
+# Priorities of the places a message can be split at, lower is better.
+PARAGRAPH, LINE, WORD, ANYWHERE = range(4)
+
+
+def utf16Length(text):
+  """Length of text as counted by telegram, in UTF-16 code units."""
+  return len(text.encode('utf-16-le')) // 2
+
+
+@functools.lru_cache(maxsize=256)
+def closers(state):
+  """Markdown closing everything open in state, see scanToken."""
+  entities, code, _ = state
+  res = ''
+  if code is not None:
+    res = '`' if code == '`' else '\n```'
+  return res + ''.join(reversed(entities))
+
+
+def openers(state):
+  """Markdown reopening everything closed by closers(state)."""
+  entities, code, _ = state
+  return ''.join(entities) + (code or '')
+
+
+def scanToken(text, pos, state):
+  """Returns (end, plain, state) for the token of text starting at pos.
+
+  state is an (entities, code, link) tuple; the markers of open entities,
+  outermost first, the opening of the code block or span we are in, if any,
+  and 1 inside the text of a link, 2 inside its url, 0 otherwise.
+  """
+  entities, code, link = state
+  m = (TOKEN_REGEX if code is None else CODE_TOKEN_REGEX).match(text, pos)
+  token = m.group()
+  end = m.end()
+  if m.lastgroup == 'plain':
+    pass
+  elif code is not None:
+    if token == '`' and code == '`' or token == '```' and code != '`':
+      code = None
+  elif token == '```':
+    end = text.find('\n', pos) + 1 or len(text)
+    code = text[pos:end]
+  elif token == '`':
+    code = token
+  elif token == '[' and link == 0:
+    link = 1
+  elif token == ']' and link == 1:
+    link = 0
+    if text.startswith('(', end):
+      link = 2
+      end += 1
+  elif token == ')' and link == 2:
+    link = 0
+  elif token in ENTITY_MARKERS and link != 2:
+    if token in entities:
+      entities = tuple(e for e in entities if e != token)
+    else:
+      entities += (token,)
+  return end, m.lastgroup == 'plain', (entities, code, link)
+
+
+def fitting(text, pos, room):
+  """Number of characters from pos that fit into room UTF-16 code units."""
+  n = 0
+  while room > 0 and pos + n < len(text):
+    # Escapes are not cut.
+    size = 2 if text[pos + n] == '\\' else 1
+    room -= utf16Length(text[pos + n:pos + n + size])
+    if room < 0:
+      break
+    n += size
+  return n
+
+
+def scanLink(text, pos, state):
+  """Returns (start of url, end) of the link whose '[' token is at pos.
+
+  None if the brackets aren't followed by a url or the link isn't closed.
+  """
+  url = None
+  while pos < len(text):
+    pos, _, after = scanToken(text, pos, state)
+    if state[2] == 1 and after[2] == 2:
+      url = pos
+    elif after[2] == 0:
+      return None if url is None else (url, pos)
+    state = after
+  return None
+
+
+def unlink(text, url, end):
+  """Plain MarkdownV2 for a link of text[:end], whose url starts at url."""
+  # Only backslashes and ')' are escaped in urls, anything else in plain text.
+  target = re.sub(r'\\(.)', r'\1', text[url:end - 1])
+  return text[1:url - 2] + ' \\(' + escape(target) + '\\)'
+
+
+def splitMarkdown(text, limit=4096):
+  """Splits MarkdownV2 text into chunks of at most limit UTF-16 code units.
+
+  Chunks end at paragraph breaks when possible, then at line breaks, then
+  between words. Escapes and links are not cut, formatting and code blocks
+  open at a split are closed at the end of the chunk and reopened in the next
+  one, so every chunk is valid markdown on its own.
+
+  A link too long for any chunk becomes plain 'text (url)', which is split
+  like other text. If even the markup to reopen doesn't leave room for text,
+  the text is cut as it is and markup isn't carried over that cut. Chunks
+  that end up unbalanced fall back to plaintext when telegram rejects them.
+  """
+  if utf16Length(text) <= limit:
+    return [text] if text else []
+  chunks = []
+  start = pos = 0
+  state = ((), None, 0)
+  prefix = ''
+  size = 0
+  # priority -> (end of chunk, start of next chunk, state at the split)
+  breaks = {}
+  # (position, state, size) at the '[' of the last link.
+  link_start = None
+  while pos < len(text):
+    end, plain, after = scanToken(text, pos, state)
+    if after[2] == 1 and state[2] == 0:
+      link_start = (pos, state, size)
+    token = text[pos:end]
+    if pos > start and state[2] == 0:
+      if token.startswith('\n\n'):
+        breaks[PARAGRAPH] = (pos, end, state)
+      elif token == '\n':
+        breaks[LINE] = (pos, end, state)
+      elif token[0] == ' ':
+        breaks[WORD] = (pos, end, state)
+      else:
+        breaks[ANYWHERE] = (pos, pos, state)
+    length = utf16Length(token)
+    if size + length + len(closers(after)) <= limit:
+      size += length
+      pos = end
+      state = after
+      continue
+    if state[2] != 0:
+      link_pos, link_state, _ = link_start
+      link = scanLink(text, link_pos, link_state)
+      # Links that don't fit even into a chunk of their own become plain text.
+      if link is not None and utf16Length(text[link_pos:link[1]]) + utf16Length(
+          openers(link_state)) + len(closers(link_state)) > limit:
+        text = text[:link_pos] + unlink(text[link_pos:link[1]],
+                                        link[0] - link_pos,
+                                        link[1] - link_pos) + text[link[1]:]
+        pos, state, size = link_start
+        continue
+    overflow = pos
+    if plain and state[2] == 0:
+      # Long words are cut wherever the chunk is full.
+      n = fitting(text, pos, limit - size - len(closers(state)))
+      if n > 0:
+        overflow = pos + n
+        breaks[ANYWHERE] = (overflow, overflow, state)
+    # Prefer the best kind of split, unless it would leave the chunk less
+    # than half full.
+    split = None
+    for priority in (PARAGRAPH, LINE, WORD, ANYWHERE):
+      candidate = breaks.get(priority)
+      if candidate is not None and candidate[0] - start >= (overflow -
+                                                            start) // 2:
+        split = candidate
+        break
+    if split is None and pos > start:
+      split = breaks.get(ANYWHERE, (pos, pos, state))
+    if split is None:
+      # Not even one token fits after the reopened markup, e.g. a code block
+      # opener with a huge language. Cut the text as it is, without markup.
+      n = max(1, fitting(text, start, limit))
+      chunks.append(text[start:start + n])
+      prefix = ''
+      start = pos = start + n
+      state = ((), None, 0)
+      size = 0
+      breaks = {}
+      continue
+    end, resume, state = split
+    chunks.append(prefix + text[start:end] + closers(state))
+    prefix = openers(state)
+    start = pos = resume
+    size = utf16Length(prefix)
+    breaks = {}
+  if start < len(text):
+    chunks.append(prefix + text[start:])
+  return chunks
+
+
+class telegramMessage:
+  """A text message rendered once into ready-to-send sendMessage payloads.
+
+  Chunks are read-only payloads without a chat_id, so a single instance can be
+  sent to any number of chats. When telegram fails to parse the markdown of a
+  chunk, the chunk is replaced with its plaintext version for all later
+  recipients.
+  """
+  MAX_LENGTH = 4096
+
+  def __init__(self, text, escaped=False):
+    if not escaped:
+      text = escape(text)
+    self.lock = threading.Lock()
+    self.chunks = tuple(
+        self.makeChunk(chunk) for chunk in splitMarkdown(text, self.MAX_LENGTH))
+
+  @staticmethod
+  def makeChunk(text, markdown=True):
+    data = {}
+    data['method'] = 'sendMessage'
+    if markdown:
+      data['parse_mode'] = 'MarkdownV2'
+    data['disable_web_page_preview'] = True
+    data['text'] = text
+    return types.MappingProxyType(data)
+
+  def toDict(self):
+    """Returns a JSON serializable copy, see fromDict."""
+    with self.lock:
+      return {'chunks': [dict(chunk) for chunk in self.chunks]}
+
+  @classmethod
+  def fromDict(cls, data):
+    message = cls.__new__(cls)
+    message.lock = threading.Lock()
+    message.chunks = tuple(
+        types.MappingProxyType(dict(chunk)) for chunk in data['chunks'])
+    return message
+
+  def fallback(self, idx, chunk):
+    """Returns the plaintext replacement for the chunk at idx."""
+    with self.lock:
+      if self.chunks[idx] is chunk and 'parse_mode' in chunk:
+        chunks = list(self.chunks)
+        chunks[idx] = self.makeChunk(unescape(chunk['text']), False)
+        self.chunks = tuple(chunks)
+      return self.chunks[idx]
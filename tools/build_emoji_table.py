@@ -0,0 +1,83 @@
+"""Builds emoji_table.tsv, the shortcode to unicode table used by the renderer.
+
+Usage:
+  python tools/build_emoji_table.py [SOURCE] [--output FILE]
+  python tools/build_emoji_table.py --emoji-package [--output FILE]
+
+SOURCE is a path or URL of github's emoji list, as returned by
+https://api.github.com/emojis (the default). Keeping a copy of that response
+around allows refreshing the table offline. With --emoji-package the table is
+generated from the `emoji` python package instead. That table has github's
+shortcodes, which Discourse uses, plus the Unicode CLDR names of every emoji
+(e.g. `thumbs_up`). The package doesn't tell which CLDR names are also
+github's shortcodes (e.g. `rocket`), so none of them are left out.
+
+Each line of the output is a shortcode and its code points in hex, separated
+by a tab, e.g. `+1\t1f44d`.
+"""
+import argparse
+import json
+import os
+import sys
+import urllib.request
+
+GITHUB_EMOJIS = 'https://api.github.com/emojis'
+OUTPUT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'emoji_table.tsv')
+
+
+def fromGithub(source):
+  if '://' in source:
+    with urllib.request.urlopen(source, timeout=30) as resp:
+      mapping = json.loads(resp.read().decode('utf-8'))
+  else:
+    with open(source) as f:
+      mapping = json.load(f)
+  table = {}
+  for key, value in mapping.items():
+    # value can be in one of two forms:
+    # https://github.githubassets.com/images/icons/emoji/unicode/1f4a4.png?v8
+    # https://github.githubassets.com/images/icons/emoji/atom.png?v8
+    # We drop the non-unicode ones. For unicode ones, sometimes there are
+    # multiple code points, e.g:
+    # https://github.githubassets.com/images/icons/emoji/unicode/1f1e6-1f1fa.png?v8
+    if '/unicode/' not in value:
+      continue
+    table[key] = value.split('/')[-1].split('.png')[0]
+  return table
+
+
+def fromEmojiPackage():
+  from emoji.unicode_codes import EMOJI_DATA
+  table = {}
+  for emoji, data in EMOJI_DATA.items():
+    # Only fully qualified emojis, others are variations of those.
+    if data.get('status') != 2:
+      continue
+    codepoints = '-'.join(f'{ord(c):x}' for c in emoji)
+    # Aliases are github's shortcodes, they take precedence over CLDR names.
+    for name in [data['en']] + data.get('alias', []):
+      table[name.strip(':')] = codepoints
+  return table
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('source', nargs='?', default=GITHUB_EMOJIS)
+  parser.add_argument('--emoji-package', action='store_true')
+  parser.add_argument('--output', default=OUTPUT)
+  args = parser.parse_args()
+
+  if args.emoji_package:
+    table = fromEmojiPackage()
+  else:
+    table = fromGithub(args.source)
+  with open(args.output, 'w', encoding='utf-8') as f:
+    for key in sorted(table):
+      f.write(f'{key}\t{table[key]}\n')
+  print(f'Wrote {len(table)} shortcodes to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,106 @@
+import collections
+import datetime
+import json
+import os
+import threading
+import time
+import traceback
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class topicCache:
+  """Bounded LRU cache of topic_id -> (category_id, title) with a TTL.
+
+  Entries are persisted to a json file so that the cache survives restarts,
+  timestamps are wall clock times for the same reason.
+  """
+
+  def __init__(self, storage=None, capacity=10000, ttl=6 * 60 * 60):
+    self.storage = storage
+    self.capacity = capacity
+    self.ttl = ttl
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    if not self.storage or not os.path.exists(self.storage):
+      return
+    try:
+      with open(self.storage) as f:
+        entries = json.load(f)
+    except Exception as e:
+      logger.error('{} {}', e, datetime.datetime.now())
+      traceback.print_exc()
+      return
+    now = time.time()
+    # Stored in LRU order, oldest first.
+    for topic_id, (category_id, title, stamp) in entries:
+      if now - stamp < self.ttl:
+        self.entries[topic_id] = (category_id, title, stamp)
+    while len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+    logger.info('Loaded {} cached topics', len(self.entries))
+
+  def save(self):
+    if not self.storage:
+      return
+    with self.lock:
+      if not self.dirty:
+        return
+      entries = [
+          [topic_id, list(entry)] for topic_id, entry in self.entries.items()
+      ]
+      self.dirty = False
+    try:
+      tmp = self.storage + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(entries, f)
+      os.replace(tmp, self.storage)
+    except Exception as e:
+      logger.error('{} {}', e, datetime.datetime.now())
+      traceback.print_exc()
+
+  def get(self, topic_id):
+    """Returns (category_id, title) or None if missing or expired."""
+    with self.lock:
+      entry = self.entries.get(topic_id)
+      if entry is None:
+        return None
+      if time.time() - entry[2] >= self.ttl:
+        del self.entries[topic_id]
+        self.dirty = True
+        return None
+      self.entries.move_to_end(topic_id)
+      return entry[0], entry[1]
+
+  def put(self, topic_id, category_id, title):
+    with self.lock:
+      self.entries[topic_id] = (category_id, title, time.time())
+      self.entries.move_to_end(topic_id)
+      while len(self.entries) > self.capacity:
+        self.entries.popitem(last=False)
+      self.dirty = True
+
+  def invalidate(self, topic_id):
+    with self.lock:
+      if self.entries.pop(topic_id, None) is not None:
+        self.dirty = True
+
+  def observe(self, topic_id, category_id, title):
+    """Refreshes a cached topic from fresh data, e.g. the latest posts list.
+
+    Topics can be moved to another category or renamed, in which case the
+    cached entry is dropped.
+    """
+    with self.lock:
+      entry = self.entries.get(topic_id)
+      if entry is None or (entry[0], entry[1]) == (category_id, title):
+        return
+      logger.info('Topic {} changed from {} to {}', topic_id, entry[:2],
+                  (category_id, title))
+      del self.entries[topic_id]
+      self.dirty = True
@@ -0,0 +1,123 @@
+import re
+import threading
+
+SEPARATOR_REGEX = re.compile(r'[\W_]+')
+
+
+def trigrams(text):
+  return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class topicSearch:
+  """Trigram index over category names for /add and /delete.
+
+  Matches are case insensitive substring matches, ranked by how well they
+  match:
+    0 - the whole name
+    1 - the last segment, e.g. '100' for 'metu.ceng.course.100'
+    2 - any segment or word of the name
+    3 - the start of a segment or word, or the end of the name
+    4 - anywhere else
+  Only the best ranked matches are returned, so a query naming a course
+  directly isn't ambiguous because longer names contain it too.
+  """
+  EXACT, LAST_SEGMENT, SEGMENT, PREFIX, SUBSTRING = range(5)
+
+  def __init__(self, names=None):
+    self.lock = threading.Lock()
+    # id -> (name, folded name, words)
+    self.entries = {}
+    # trigram -> ids of names containing it
+    self.grams = {}
+    if names:
+      self.update({}, names)
+
+  def add(self, cat_id, name):
+    folded = name.casefold()
+    words = tuple(w for w in SEPARATOR_REGEX.split(folded) if w)
+    self.entries[cat_id] = (name, folded, words)
+    for gram in trigrams(folded):
+      self.grams.setdefault(gram, set()).add(cat_id)
+
+  def remove(self, cat_id):
+    _, folded, _ = self.entries.pop(cat_id)
+    for gram in trigrams(folded):
+      self.discard(self.grams, gram, cat_id)
+
+  @staticmethod
+  def discard(table, key, cat_id):
+    ids = table.get(key)
+    if ids is not None:
+      ids.discard(cat_id)
+      if not ids:
+        del table[key]
+
+  def update(self, old, new):
+    """Applies the difference between two {id: name} maps."""
+    with self.lock:
+      for cat_id, name in old.items():
+        if new.get(cat_id) != name and cat_id in self.entries:
+          self.remove(cat_id)
+      for cat_id, name in new.items():
+        if cat_id not in self.entries:
+          self.add(cat_id, name)
+
+  def candidates(self, query):
+    """Ids of the names containing query, which must be case folded."""
+    if len(query) < 3:
+      # Too short for trigrams, scan the names instead.
+      return {
+          cat_id for cat_id, (_, folded, _) in self.entries.items()
+          if query in folded
+      }
+    sets = []
+    for gram in trigrams(query):
+      ids = self.grams.get(gram)
+      if ids is None:
+        return set()
+      sets.append(ids)
+    sets.sort(key=len)
+    ids = set(sets[0])
+    for other in sets[1:]:
+      ids &= other
+    return {cat_id for cat_id in ids if query in self.entries[cat_id][1]}
+
+  def rank(self, query, folded, words):
+    if folded == query:
+      return self.EXACT
+    segments = folded.split('.')
+    if segments[-1] == query:
+      return self.LAST_SEGMENT
+    if query in segments or query in words:
+      return self.SEGMENT
+    if folded.endswith(query) or any(
+        s.startswith(query) for s in segments) or any(
+            w.startswith(query) for w in words):
+      return self.PREFIX
+    return self.SUBSTRING
+
+  def search(self, query, within=None):
+    """Returns the best matching names for query, sorted.
+
+    within optionally restricts the results to the given names, e.g. to the
+    topics a user follows.
+    """
+    query = query.strip().casefold()
+    if not query:
+      return []
+    if within is not None:
+      within = set(within)
+    best = None
+    res = []
+    with self.lock:
+      for cat_id in self.candidates(query):
+        name, folded, words = self.entries[cat_id]
+        if within is not None and name not in within:
+          continue
+        rank = self.rank(query, folded, words)
+        if best is None or rank < best:
+          best = rank
+          res = []
+        if rank == best:
+          res.append(name)
+    return sorted(res, key=lambda name: (len(name), name))
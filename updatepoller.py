@@ -0,0 +1,86 @@
+import datetime
+import os
+import threading
+import time
+import traceback
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class updatePoller(threading.Thread):
+  """Pulls updates with getUpdates long polling instead of a webhook.
+
+  Updates are put into the queue consumed by cowBot.run in batches of up to
+  LIMIT. The offset is only confirmed, both to telegram and to offset_file,
+  once the whole batch was processed, so updates are handled at least once
+  even across restarts.
+  """
+  LIMIT = 100
+
+  def __init__(self, conf, bot, q):
+    threading.Thread.__init__(self, daemon=True)
+    self.bot = bot
+    self.q = q
+    self.timeout = conf['bot'].get('poll_timeout', 50)
+    self.offset_file = conf['bot'].get('offset_file', 'update_offset')
+    self.offset = self.loadOffset()
+
+  def loadOffset(self):
+    if not os.path.exists(self.offset_file):
+      return None
+    try:
+      with open(self.offset_file) as f:
+        return int(f.read().strip())
+    except Exception as e:
+      logger.error('{} {}', e, datetime.datetime.now())
+      traceback.print_exc()
+      return None
+
+  def saveOffset(self):
+    tmp = self.offset_file + '.tmp'
+    with open(tmp, 'w') as f:
+      f.write(str(self.offset))
+    os.replace(tmp, self.offset_file)
+
+  def getUpdates(self):
+    data = {
+        'method': 'getUpdates',
+        'limit': self.LIMIT,
+        'timeout': self.timeout,
+        'allowed_updates': ['message', 'edited_message'],
+    }
+    if self.offset is not None:
+      data['offset'] = self.offset
+    resp = self.bot.session.post(
+        self.bot.url, json=data, timeout=self.timeout + 10).json()
+    if not resp['ok']:
+      raise RuntimeError(f'getUpdates failed with {resp}')
+    return resp['result']
+
+  def run(self):
+    backoff = 1
+    while True:
+      try:
+        updates = self.getUpdates()
+        backoff = 1
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
+        logger.error('Retrying in {} seconds', backoff)
+        time.sleep(backoff)
+        backoff = min(60, backoff * 2)
+        continue
+      if not updates:
+        continue
+      for update in updates:
+        logger.info('Received {}', update)
+        self.q.put(update)
+      # Wait for the batch to be processed before confirming it.
+      self.q.join()
+      self.offset = updates[-1]['update_id'] + 1
+      try:
+        self.saveOffset()
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
@@ -0,0 +1,69 @@
+import collections
+import threading
+import traceback
+import datetime
+from logger import getLogger
+
+logger = getLogger(__name__)
+
+
+class keyedWorkerPool:
+  """Runs jobs on a fixed set of threads, serializing jobs that share a key.
+
+  Jobs submitted with the same key are executed one at a time in submission
+  order, jobs with different keys run in parallel. A key is only handed to a
+  worker when it is not being processed by another one, so a slow key never
+  blocks the others.
+  """
+
+  def __init__(self, name, workers, maxsize=0):
+    self.name = name
+    self.maxsize = maxsize
+    self.cond = threading.Condition()
+    # key -> deque of pending jobs. A key is present while it has pending jobs
+    # or while one of its jobs is running.
+    self.pending = {}
+    # Keys that have pending jobs and are not running.
+    self.ready = collections.deque()
+    self.size = 0
+    self.threads = []
+    for i in range(workers):
+      t = threading.Thread(target=self.work, name=f'{name}-{i}', daemon=True)
+      t.start()
+      self.threads.append(t)
+
+  def qsize(self):
+    return self.size
+
+  def submit(self, key, fn, *args):
+    """Queues fn(*args) under key, blocks while the pool is full."""
+    with self.cond:
+      while self.maxsize and self.size >= self.maxsize:
+        self.cond.wait()
+      jobs = self.pending.get(key)
+      if jobs is None:
+        jobs = self.pending[key] = collections.deque()
+        self.ready.append(key)
+      jobs.append((fn, args))
+      self.size += 1
+      self.cond.notify_all()
+
+  def work(self):
+    while True:
+      with self.cond:
+        while not self.ready:
+          self.cond.wait()
+        key = self.ready.popleft()
+        fn, args = self.pending[key].popleft()
+      try:
+        fn(*args)
+      except Exception as e:
+        logger.error('{} {}', e, datetime.datetime.now())
+        traceback.print_exc()
+      with self.cond:
+        if self.pending[key]:
+          self.ready.append(key)
+        else:
+          del self.pending[key]
+        self.size -= 1
+        self.cond.notify_all()